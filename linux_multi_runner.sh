@@ -1,6 +1,6 @@
 #!/bin/bash
 
-SCRIPT_PATH="py_main.py"
+SCRIPT_PATH="py_batch.py"
 
 # Farbdefinitionen
 RED='\033[0;31m'
@@ -96,21 +96,11 @@ echo -e "   Provider: ${YELLOW}$PROVIDER${NC}"
 echo -e "   Names: ${YELLOW}$NAMES${NC}"
 echo
 
-# Verarbeitung starten
-COUNTER=1
-TOTAL=$(echo $NAMES | wc -w)
+# Verarbeitung starten: alle Namen in einem Prozess, die Downloads teilen sich Pools und Caches
+python3 "$SCRIPT_PATH" --type "$TYPE" --lang "$LANGUAGE" --dl-mode "$DLMODE" --provider "$PROVIDER" $NAMES
 
-for NAME in $NAMES; do
-    echo -e "${PURPLE}📦 Processing $COUNTER/$TOTAL: $NAME${NC}"
-    python3 "$SCRIPT_PATH" --type "$TYPE" --name "$NAME" --lang "$LANGUAGE" --dl-mode "$DLMODE" --provider "$PROVIDER"
-    
-    if [ $? -eq 0 ]; then
-        echo -e "${GREEN}✅ Success: $NAME${NC}"
-    else
-        echo -e "${RED}❌ Failed: $NAME${NC}"
-    fi
-    echo
-    ((COUNTER++))
-done
-
-echo -e "${GREEN}🎉 All done! Processed $((COUNTER-1)) items.${NC}"
\ No newline at end of file
+if [ $? -eq 0 ]; then
+    echo -e "${GREEN}🎉 All done! Processed $(echo $NAMES | wc -w) items.${NC}"
+else
+    echo -e "${RED}❌ Some items failed. Please check the log.${NC}"
+fi
\ No newline at end of file
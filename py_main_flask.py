@@ -1,15 +1,16 @@
 from flask import Flask, request, jsonify, render_template, make_response, Response, stream_with_context, redirect, url_for, flash
 import json
-import subprocess
 import threading
 import os
 import re
-import signal
 import time
 from flask_socketio import SocketIO, emit
 import logging
 from src.custom_logging import setup_logger,init_logger_socketio
+from src.job_queue import DONE, DOWNLOADING, FAILED, JOBS_FILE, JobQueue
+from src.logic.pipeline import Progress, RunSettings, SeriesSpec
 from src.r_w_file_handler import read_config_variable, update_config_variable
+from src.start_app import check_environment, download_series
 
 import queue  # neu: für SSE-subscriber Queues
 
@@ -17,7 +18,8 @@ logger = setup_logger(__name__)
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'dev-secret-for-local')  # für Produktion: echte geheime Variable
-socketio = SocketIO(app, cors_allowed_origins="*", logger=True, engineio_logger=True)
+# echte Threads: die Downloads laufen im Server-Prozess (Thread-Pools, asyncio-Loop pro Job)
+socketio = SocketIO(app, async_mode='threading', cors_allowed_origins="*", logger=True, engineio_logger=True)
 
 try:
     # Logger mit WebSocket initialisieren
@@ -103,8 +105,8 @@ def _sanitize_name(name, max_length=200):
 
 def validate_and_sanitize_form(form):
     allowed_types = {'anime': 'anime', 'serie': 'serie'}
-    allowed_langs = {'deutsch': 'Deutsch', 'english': 'English' , 'ger-sub': 'ger-sub'}
-    allowed_modes = {'series': 'Series', 'movie': 'Movie' , 'all': 'All'}
+    allowed_langs = {'deutsch': 'Deutsch', 'english': 'English' , 'ger-sub': 'Ger-Sub'}
+    allowed_modes = {'series': 'Series', 'movie': 'Movies', 'movies': 'Movies', 'all': 'All'}
     allowed_providers = {'voe': 'VOE', 'streamtape': 'Streamtape', 'vidoza': 'Vidoza'}
     allowed_season_overrides = {str(i) for i in range(0, 11)} | {f"{i}+" for i in range(1, 11)}
 
@@ -170,86 +172,105 @@ def validate_and_sanitize_form(form):
     }
 
 
-# globales Tracking
-active_processes = []
-current_process_lock = threading.Lock()
-
-def run_download_script(sanitized_data):
-    global active_processes
+# globales Tracking: Job-ID -> Progress des laufenden Downloads
+active_jobs = {}
+active_jobs_lock = threading.Lock()
+
+# --- Job-Queue ---
+# liegt in output_root, damit die Jobs einen Neustart des Containers überleben
+job_queue = JobQueue(os.path.join(read_config_variable("output_root", "output"), JOBS_FILE))
+job_workers = max(1, read_config_variable("job_workers", 1))
+JOB_POLL_INTERVAL = 5  # Sekunden; findet auch Jobs, die ein anderer Prozess eingereiht hat
+# Progress-Events, die als Zeile im Log-Stream landen
+PROGRESS_LOG_EVENTS = {'series', 'downloading', 'done', 'failed', 'unavailable'}
+
+
+def series_spec(sanitized_data):
+    """SeriesSpec aus den bereinigten Formulardaten, mit den Einstellungen, die gerade in der Config stehen."""
+    season_override = str(sanitized_data.get('season_override') or '0')
+    return SeriesSpec(
+        sanitized_data.get('type_of_media', 'anime'),
+        sanitized_data.get('name', 'Name-Goes-Here'),
+        sanitized_data.get('language', 'Deutsch'),
+        sanitized_data.get('dlMode', 'Series'),
+        season_override if '+' in season_override else int(season_override),
+        sanitized_data.get('cliProvider', 'VOE'),
+        RunSettings.read(),
+    )
+
+
+def progress_listener(job_id):
+    """Leitet die Progress-Events eines Jobs an die Clients weiter und pflegt den Job-Status."""
+    started = threading.Event()
+
+    def listener(event, data):
+        if event == 'downloading' and not started.is_set():
+            started.set()
+            job_queue.set_state(job_id, DOWNLOADING)
+        socketio.emit('job_progress', {'job_id': job_id, 'event': event, **data})
+        if event in PROGRESS_LOG_EVENTS:
+            text = ' '.join(str(value) for value in data.values())
+            broadcast_log(f"Job {job_id}: {event} {text}", level='ERROR' if event == 'failed' else 'INFO')
+
+    return listener
+
+
+def run_job(job):
+    """Lädt die Serie eines Jobs im Worker-Thread herunter und gibt (Status, Nachricht) zurück."""
+    job_id = job['id']
+    spec = series_spec(job['spec'])
+    logger.info(f"🔧 Starte Download: {spec}")
+    broadcast_log(f"🔧 Starte Download: {spec}")
+
+    if not check_environment(spec.settings.output_root):
+        return FAILED, "Umgebung nicht bereit (Rechte oder FFMPEG)"
+
+    progress = Progress(progress_listener(job_id))
+    with active_jobs_lock:
+        active_jobs[job_id] = progress
     try:
-        cmd = [
-            'python3', 'py_main.py',
-            '--type', str(sanitized_data.get('type_of_media', 'anime')),
-            '--name', str(sanitized_data.get('name', 'Name-Goes-Here')),
-            '--lang', str(sanitized_data.get('language', 'Deutsch')),
-            '--dl-mode', str(sanitized_data.get('dlMode', 'Series')),
-            '--provider', str(sanitized_data.get('cliProvider', 'VOE')),
-            '--season-override', str(sanitized_data.get('season_override', '0')),
-            '--episode-override', str(sanitized_data.get('episode_override', '0'))
-        ]
-
-        logger.info(f"🔧 Starte Download: {' '.join(cmd)}")
-        broadcast_log(f"🔧 Starte Download: {' '.join(cmd)}")
-
-        # Plattform-spezifische Optionen: neue Prozessgruppe erstellen
-        popen_kwargs = dict(
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
-            bufsize=1,
-            universal_newlines=True
-        )
-        if os.name == 'nt':
-            # Windows
-            popen_kwargs['creationflags'] = subprocess.CREATE_NEW_PROCESS_GROUP
-        else:
-            # Unix (start new session => eigene PGID)
-            popen_kwargs['start_new_session'] = True
-
-        process = subprocess.Popen(cmd, **popen_kwargs)
-
-        # füge zum list der aktiven prozesse hinzu (thread-sicher)
-        with current_process_lock:
-            active_processes.append(process)
-
-        # Live-Output lesen
-        for line in iter(process.stdout.readline, ''):
-            if line is None:
-                break
-            text = line.rstrip('\n').strip()
-            if not text:
-                continue  # leere Zeilen überspringen
-
-            # Wenn Zeile nur "[PY_MAIN]" enthält -> überspringen
-            if text == "[PY_MAIN]" or (text.startswith("[PY_MAIN]") and len(text) < 15):
-                continue
-
-            logger.info(f"{text}")
-            broadcast_log(text)
-
-        # warten
-        returncode = process.wait()
-
-        if returncode == 0:
-            logger.info("✅ Download erfolgreich abgeschlossen")
-            broadcast_log("✅ Download erfolgreich abgeschlossen")
-        else:
-            logger.error(f"❌ Download mit Fehlercode {returncode} beendet")
-            broadcast_log(f"❌ Download mit Fehlercode {returncode} beendet", level='ERROR')
-
-
+        download_series(spec, progress)
     except Exception as e:
         logger.error(f"❌ Fehler beim Download: {str(e)}")
-        broadcast_log(f"❌ Fehler beim Download: {str(e)}")
-
+        broadcast_log(f"❌ Fehler beim Download: {str(e)}", level='ERROR')
+        return FAILED, str(e)
     finally:
-        # entferne prozess aus liste (thread-sicher)
-        with current_process_lock:
-            try:
-                if process in active_processes:
-                    active_processes.remove(process)
-            except (NameError, ValueError):
-                pass
+        with active_jobs_lock:
+            active_jobs.pop(job_id, None)
+
+    counts = progress.counts
+    summary = f"{counts['done']} heruntergeladen, {counts['skipped']} vorhanden, " \
+              f"{counts['failed'] + counts['unavailable']} fehlgeschlagen"
+    if progress.cancelled:
+        return FAILED, f"gestoppt ({summary})"
+    if counts['failed'] or counts['unavailable']:
+        logger.error(f"❌ Download mit Fehlern beendet: {summary}")
+        broadcast_log(f"❌ Download mit Fehlern beendet: {summary}", level='ERROR')
+        return FAILED, summary
+    logger.info(f"✅ Download erfolgreich abgeschlossen: {summary}")
+    broadcast_log(f"✅ Download erfolgreich abgeschlossen: {summary}")
+    return DONE, summary
+
+
+def job_worker():
+    """Arbeitet die Job-Queue ab, ein Job nach dem anderen."""
+    while True:
+        job = job_queue.claim()
+        if job is None:
+            job_queue.wait(JOB_POLL_INTERVAL)
+            continue
+
+        broadcast_log(f"▶ Starte Job {job['id']}: {job['spec'].get('name')}")
+        state, message = run_job(job)
+        job_queue.set_state(job['id'], state, message)
+
+
+def start_job_workers():
+    """Setzt unterbrochene Jobs zurück in die Queue und startet die festen Worker."""
+    job_queue.requeue_interrupted()
+    for _ in range(job_workers):
+        socketio.start_background_task(job_worker)
+    logger.info(f"{job_workers} Job-Worker gestartet")
 
 
 @app.route('/', methods=['GET', 'POST'])
@@ -269,10 +290,16 @@ def index():
             flash("Ungültige Eingabe. Bitte überprüfen Sie Ihre Daten.", "error")
             return redirect(url_for('index'))
 
-        # Hintergrund-Task mit socketio starten (robuster als threading.Thread)
-        socketio.start_background_task(run_download_script, sanitized)
+        try:
+            priority = int(request.form.get('priority', 0) or 0)
+        except ValueError:
+            logger.warning(f"Unbekannte Priorität '{request.form.get('priority')}'")
+            priority = 0
+
+        # die Job-Worker arbeiten die Queue ab, egal wie viele Downloads eingereicht werden
+        job_id = job_queue.submit(sanitized, priority)
 
-        flash("Download gestartet!", "success")
+        flash(f"Download eingereiht (Job {job_id})!", "success")
         # Redirect auf die GET-Version der Index-Seite (PRG)
         return redirect(url_for('index'))
 
@@ -281,8 +308,8 @@ def index():
 def settings():
     if request.method == 'POST':
         # Werte aus dem Formular lesen
-        for var in ["ddos_protection_calc", "ddos_wait_timer", "max_download_threads",
-                    "thread_download_wait_timer", "disable_thread_timer" , "output_root", "episode_override"]:
+        for var in ["rate_limit_initial", "rate_limit_max", "max_download_threads",
+                    "download_queue_size", "output_root", "episode_override"]:
             if var in request.form:
                 value = request.form[var]
                 update_config_variable(var, value)
@@ -291,12 +318,36 @@ def settings():
 
     # GET: aktuelle Werte auslesen
     config = {}
-    for var in ["ddos_protection_calc", "ddos_wait_timer", "max_download_threads",
-                "thread_download_wait_timer", "disable_thread_timer" , "output_root", "episode_override"]:
+    for var in ["rate_limit_initial", "rate_limit_max", "max_download_threads",
+                "download_queue_size", "output_root", "episode_override"]:
         config[var] = read_config_variable(var, default="")
 
     return render_template('settings.html', config=config)
 
+@app.route('/jobs')
+def jobs():
+    """Offene Jobs in der Reihenfolge, in der sie laufen werden, danach die zuletzt beendeten."""
+    return jsonify(job_queue.jobs())
+
+
+@app.route('/jobs/<int:job_id>/priority', methods=['POST'])
+def job_priority(job_id):
+    try:
+        priority = int((request.get_json(silent=True) or request.form).get('priority'))
+    except (TypeError, ValueError):
+        return jsonify({'status': 'error', 'message': 'Ungültige Priorität'}), 400
+    if not job_queue.set_priority(job_id, priority):
+        return jsonify({'status': 'error', 'message': 'Job nicht gefunden'}), 404
+    return jsonify(job_queue.get(job_id))
+
+
+@app.route('/jobs/<int:job_id>/cancel', methods=['POST'])
+def job_cancel(job_id):
+    if not job_queue.cancel(job_id):
+        return jsonify({'status': 'error', 'message': 'Job ist nicht (mehr) in der Queue'}), 409
+    return jsonify(job_queue.get(job_id))
+
+
 @app.route('/log_stream')
 def log_stream():
     client_q = subscribe()
@@ -324,78 +375,22 @@ def log_stream():
 
 @app.route('/stop', methods=['POST'])
 def stop_current_process():
-    """Versucht alle laufenden Download-Prozesse zu stoppen."""
-    global active_processes
-    
-    with current_process_lock:
-        processes_to_stop = list(active_processes)
+    """Stoppt alle laufenden Jobs: es werden keine weiteren Episoden gestartet, laufende Downloads enden noch."""
+    with active_jobs_lock:
+        jobs_to_stop = dict(active_jobs)
 
-    if not processes_to_stop:
-        # kein laufender Prozess
+    if not jobs_to_stop:
+        # kein laufender Job
         return jsonify({'status': 'no_process', 'message': 'Kein laufender Prozess'}), 400
 
-    try:
-        stopped_count = 0
-        broadcast_log(f"⏹ Stop-Anfrage erhalten. Stoppe {len(processes_to_stop)} Prozess(e)...")
-        logger.info(f"Stop-Anfrage erhalten. Stoppe {len(processes_to_stop)} Prozess(e)...")
-
-        for p in processes_to_stop:
-            if p.poll() is not None:
-                # Prozess bereits beendet
-                continue
-
-            try:
-                # Versuche sauberes Signal
-                if os.name == 'nt':
-                    try:
-                        # send CTRL_BREAK to the process group (works when created with CREATE_NEW_PROCESS_GROUP)
-                        p.send_signal(signal.CTRL_BREAK_EVENT)
-                    except Exception:
-                        try:
-                            p.terminate()
-                        except Exception:
-                            pass
-                else:
-                    try:
-                        # send SIGINT to process group
-                        os.killpg(os.getpgid(p.pid), signal.SIGINT)
-                    except Exception:
-                        try:
-                            p.terminate()
-                        except Exception:
-                            pass
-
-                # Warte kurz auf beendigung
-                try:
-                    p.wait(timeout=5)
-                except Exception:
-                    # falls noch alive -> kill
-                    try:
-                        p.kill()
-                    except Exception:
-                        pass
-                    try:
-                        p.wait(timeout=2)
-                    except Exception:
-                        pass
-                
-                stopped_count += 1
-            except Exception as e:
-                logger.warning(f"Fehler beim Stoppen eines Prozesses: {str(e)}")
-
-        broadcast_log(f"⏹ {stopped_count} Prozess(e) gestoppt")
-        logger.info(f"{stopped_count} Prozess(e) gestoppt")
-
-        # Leere die Liste der aktiven Prozesse
-        with current_process_lock:
-            active_processes.clear()
-
-        return jsonify({'status': 'stopped', 'message': f'{stopped_count} Prozess(e) gestoppt'}), 200
+    for progress in jobs_to_stop.values():
+        progress.cancel()
+
+    message = f"{len(jobs_to_stop)} Job(s) gestoppt, laufende Episoden werden noch fertig geladen"
+    broadcast_log(f"⏹ {message}")
+    logger.info(message)
+    return jsonify({'status': 'stopped', 'message': message}), 200
 
-    except Exception as e:
-        logger.exception("Fehler beim Stoppen der Prozesse")
-        return jsonify({'status': 'error', 'message': str(e)}), 500
-    
 @socketio.on('connect')
 def on_connect():
     logger.info(f"Client connected: {request.sid}")
@@ -403,6 +398,12 @@ def on_connect():
         socketio.emit('log_output', {'data': 'Connected to server', 'level': 'INFO'})
 
 
+# Worker nicht im Reloader-Elternprozess von "python py_main_flask.py" starten, nur im Server-Prozess
+# (und nicht in Parse-Prozessen, die das Hauptmodul als __mp_main__ importieren)
+if __name__ != '__mp_main__' and (__name__ != '__main__' or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'):
+    start_job_workers()
+
+
 if __name__ == '__main__':
     #host = os.environ.get('FLASK_HOST', '0.0.0.0')
     #port = int(os.environ.get('FLASK_PORT', 5000))
@@ -0,0 +1,165 @@
+import argparse
+import re
+from collections import deque
+
+from src.constants import APP_VERSION, site_url
+from src.custom_logging import setup_logger
+from src.failures import append_failure
+from src.logic.collect_all_seasons_and_episodes import SeriesIndex
+from src.logic.library import get_manifest
+from src.logic.pipeline import SeriesSpec
+from src.start_app import check_environment, finish_run, run_jobs, series_jobs
+
+logger = setup_logger(__name__)
+
+# ------------------------------------------------------- #
+#                   definitions
+# ------------------------------------------------------- #
+# order of the values in a line of a spec file
+SPEC_FIELDS = ["type_of_media", "name", "language", "dl_mode", "season_override", "provider"]
+SEASON_OVERRIDE_PATTERN = re.compile(r"^\d+\+?$")
+
+# ------------------------------------------------------- #
+#                      functions
+# ------------------------------------------------------- #
+
+
+def make_spec(values):
+    """SeriesSpec of a dict with the SPEC_FIELDS, raises ValueError for values py_main.py would not accept."""
+    if values["type_of_media"] not in site_url:
+        raise ValueError(f"Unknown type '{values['type_of_media']}', use one of {', '.join(site_url)}.")
+    season_override = str(values["season_override"])
+    if not SEASON_OVERRIDE_PATTERN.match(season_override):
+        raise ValueError(f"Invalid season override '{season_override}', use NUM or NUM+.")
+    return SeriesSpec(values["type_of_media"], values["name"], values["language"], values["dl_mode"],
+                      season_override if "+" in season_override else int(season_override), values["provider"])
+
+
+def read_spec_file(file_name, defaults):
+    """
+    SeriesSpecs of a file with one show per line:
+    <type> <name> [language] [dl-mode] [season-override] [provider]
+    Missing values are taken from defaults, '#' starts a comment.
+    """
+    specs = []
+    with open(file_name, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            parts = line.split("#", 1)[0].split()
+            if not parts:
+                continue
+            if len(parts) < 2 or len(parts) > len(SPEC_FIELDS):
+                raise ValueError(f"{file_name}:{line_number}: expected <type> <name> [language] [dl-mode] "
+                                 f"[season-override] [provider].")
+            try:
+                specs.append(make_spec({**defaults, **dict(zip(SPEC_FIELDS, parts))}))
+            except ValueError as e:
+                raise ValueError(f"{file_name}:{line_number}: {e}")
+    return specs
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Download several shows in one process. Shows given by name use the options as their values.")
+    parser.add_argument("names", nargs="*", help="names of the shows, formatted as word-word-word")
+    parser.add_argument("-f", "--file", action="append", default=[],
+                        help="file with one show per line: <type> <name> [language] [dl-mode] [season-override] "
+                             "[provider]")
+    parser.add_argument("-t", "--type", default="anime", choices=list(site_url), dest="type_of_media")
+    parser.add_argument("-l", "--lang", default="Deutsch", dest="language")
+    parser.add_argument("-m", "--dl-mode", default="Series", choices=["Movies", "Series", "All"], dest="dl_mode")
+    parser.add_argument("-s", "--season-override", default="0", dest="season_override")
+    parser.add_argument("-p", "--provider", default="VOE", choices=["VOE", "Vidoza", "Streamtape"])
+    parser.add_argument("--missing", action="store_true",
+                        help="only list the episodes the library manifest has no file of, download nothing")
+    arguments = parser.parse_args(argv)
+
+    defaults = {field: getattr(arguments, field) for field in SPEC_FIELDS if field != "name"}
+    try:
+        specs = [spec for file_name in arguments.file for spec in read_spec_file(file_name, defaults)]
+        specs += [make_spec({**defaults, "name": name}) for name in arguments.names]
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    if not specs:
+        parser.error("no shows given")
+    return specs, arguments.missing
+
+
+def interleave(series_list):
+    """
+    EpisodeJobs of all series_list, taken from the shows in turn. While one
+    show is looked up or has nothing left, the others keep the pipeline busy.
+    A show that can't be looked up is logged as failed and skipped.
+    """
+    # shows are looked up when it is their turn, not all before the first download
+    pending = deque((series, None) for series in series_list)
+    while pending:
+        series, jobs = pending.popleft()
+        try:
+            if jobs is None:
+                jobs = series_jobs(series)
+            job = next(jobs)
+        except StopIteration:
+            logger.info(f"Listed every missing episode of {series}.")
+            continue
+        except Exception as e:
+            logger.error(f"Could not list the episodes of {series}: {e}")
+            append_failure(str(series))
+            continue
+        pending.append((series, jobs))
+        yield job
+
+
+def list_missing(series_list):
+    """
+    Log the episodes and movies of every show of series_list that have no
+    file in output_root, going by the library manifest after reconciling it
+    with the disk. Returns False if there is no manifest.
+    """
+    manifest = get_manifest()
+    if manifest is None:
+        logger.error("Listing missing episodes needs the library manifest (library_manifest=1 and output_root).")
+        return False
+    manifest.reconcile_library()
+    for series in series_list:
+        try:
+            series_index = SeriesIndex(series.url)
+        except Exception as e:
+            logger.error(f"Could not look up {series}: {e}")
+            continue
+        seasons = []
+        if series.dl_mode.lower() != "series":
+            seasons.append((0, series_index.movie_count()))
+        if series.dl_mode.lower() != "movies":
+            seasons += [(season, series_index.episode_count(season))
+                        for season in range(1, series_index.season_count + 1)]
+        complete = True
+        for season, episode_count in seasons:
+            missing = manifest.missing_episodes(series.name, season, episode_count, series.language)
+            if missing:
+                complete = False
+                logger.info(f"{series}: {'movies' if not season else f'season {season}'} is missing "
+                            f"{', '.join(map(str, missing))} of {episode_count}.")
+        if complete:
+            logger.info(f"{series}: nothing missing.")
+    return True
+
+# ------------------------------------------------------- #
+#                       main
+# ------------------------------------------------------- #
+
+
+def main(argv=None):
+    series_list, missing = parse_arguments(argv)
+    if missing:
+        list_missing(series_list)
+        return
+    logger.info("------------- AnimeSerienScraper {} batch of {} show(s) started ------------".format(
+        APP_VERSION, len(series_list)))
+    for series in series_list:
+        logger.info(f"Queued {series}.")
+
+    if not check_environment():
+        exit()
+    # one download pool, one HTTP session and one page cache for every show
+    run_jobs(interleave(series_list))
+    finish_run()
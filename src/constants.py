@@ -74,12 +74,33 @@ dlMode = parse_cli_arguments("Series", 4) if use_old_parse else get_arg("MODE",
 season_override = parse_cli_arguments(2, 5) if use_old_parse else get_arg("SEASON", 0)  # 0 = no override. 1 = season 1. etc...
 cliProvider = parse_cli_arguments("VOE", 6) if use_old_parse else get_arg("PROVIDER", "VOE")  # 0 = no override. 1 = season 1. etc...
 episode_override = read_config_variable("episode_override")  # 0 = no override. 1 = episode 1. etc...
-ddos_protection_calc = read_config_variable("ddos_protection_calc")
-ddos_wait_timer = read_config_variable("ddos_wait_timer")  # in seconds
-max_download_threads = read_config_variable("max_download_threads") # This does NOT limit the threads but won't start more when the DDOS Timer starts.
-thread_download_wait_timer = read_config_variable("thread_download_wait_timer")  # in seconds
-disable_thread_timer = read_config_variable("disable_thread_timer") # If true the script will start downloads as soon as the ddos protection is over.
+rate_limit_initial = read_config_variable("rate_limit_initial", 2)  # requests per second and host to start with
+rate_limit_max = read_config_variable("rate_limit_max", 10)  # requests per second and host at most
+max_download_threads = read_config_variable("max_download_threads", 1)  # number of downloads running at the same time.
+download_queue_size = read_config_variable("download_queue_size", max_download_threads)  # resolved episodes per provider waiting for a free download worker.
+resolve_workers = read_config_variable("resolve_workers", 1)  # episodes resolved at the same time while downloads run.
+stream_offer_pages = read_config_variable("stream_offer_pages", 1)  # 1 = stop reading an episode page once its offers are known.
+parse_processes = read_config_variable("parse_processes", 0)  # processes parsing pages while resolving. 0 = parse in the resolving thread.
+resolve_connections_per_host = read_config_variable("resolve_connections_per_host", 4)  # page requests per host while resolving.
+resolve_queue_size = read_config_variable("resolve_queue_size", 4)  # episodes waiting to be resolved.
+download_limits = {  # downloads of one provider running at the same time. 0 = only max_download_threads applies.
+    "VOE": read_config_variable("download_limit_voe", 0),
+    "Vidoza": read_config_variable("download_limit_vidoza", 0),
+    "Streamtape": read_config_variable("download_limit_streamtape", 0),
+}
 output_root = read_config_variable("output_root")
+library_manifest = read_config_variable("library_manifest", 1)  # 1 = keep a manifest of downloaded episodes in output_root.
+download_segments = {  # parallel connections per episode for direct mp4 providers. 1 = single connection.
+    "Vidoza": read_config_variable("download_segments_vidoza", 1),
+    "Streamtape": read_config_variable("download_segments_streamtape", 1),
+}
+http_connect_timeout = read_config_variable("http_connect_timeout", 10)  # in seconds
+http_read_timeout = read_config_variable("http_read_timeout", 60)  # in seconds
+http_pool_size = read_config_variable("http_pool_size", 16)  # keep-alive connections per host
+page_cache_ttl_series = read_config_variable("page_cache_ttl_series", 0)  # in seconds. 0 = don't cache series pages.
+page_cache_ttl_season = read_config_variable("page_cache_ttl_season", 0)  # in seconds. 0 = don't cache season pages.
+page_cache_ttl_episode = read_config_variable("page_cache_ttl_episode", 0)  # in seconds. 0 = don't cache episode pages.
+hls_segment_workers = read_config_variable("hls_segment_workers", 0)  # parallel HLS segment downloads for VOE. 0 = ffmpeg fetches the stream.
 output_name = normalize_name_for_folder(name)
 output_path = f"{output_root}/{type_of_media}/{output_name}"
 site_url = {
@@ -87,6 +108,13 @@ site_url = {
     "anime": "https://aniworld.to"
 }
 provider_priority = ["VOE", "Vidoza", "Streamtape"]
+provider_hedge_delay = read_config_variable("provider_hedge_delay", 0)  # in seconds. Start the next provider if the current one is slower. 0 = one after another.
+provider_score_half_life = read_config_variable("provider_score_half_life", 72)  # in hours. Age after which old provider measurements count half.
+retry_attempts = read_config_variable("retry_attempts", 4)  # tries per page, cache url and download
+retry_base_delay = read_config_variable("retry_base_delay", 2)  # in seconds. Doubled after every failed try...
+retry_max_delay = read_config_variable("retry_max_delay", 60)  # in seconds. ...up to this limit.
+circuit_breaker_threshold = read_config_variable("circuit_breaker_threshold", 5)  # failures in a row until a host is paused. 0 = never.
+circuit_breaker_cooldown = read_config_variable("circuit_breaker_cooldown", 60)  # in seconds
 
 url = "{}/{}/stream/{}/".format(site_url[type_of_media], type_of_media, name)
 
@@ -0,0 +1,212 @@
+import ctypes
+import json
+import os
+import socket
+import sqlite3
+import time
+from threading import Condition, Lock
+
+from src.custom_logging import setup_logger
+
+logger = setup_logger(__name__)
+
+# ------------------------------------------------------- #
+#                   definitions
+# ------------------------------------------------------- #
+JOBS_FILE = ".jobs.sqlite3"
+QUEUED = "queued"
+RESOLVING = "resolving"
+DOWNLOADING = "downloading"
+DONE = "done"
+FAILED = "failed"
+JOB_STATES = [QUEUED, RESOLVING, DOWNLOADING, DONE, FAILED]
+# states of jobs a worker is busy with
+ACTIVE_STATES = [RESOLVING, DOWNLOADING]
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    spec TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    state TEXT NOT NULL,
+    message TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    owner TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_by_state ON jobs (state, priority DESC, id);
+"""
+# Windows process access right and exit code of a running process, for process_alive()
+PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+STILL_ACTIVE = 259
+
+# ------------------------------------------------------- #
+#                      classes
+# ------------------------------------------------------- #
+
+
+class JobQueue:
+    """
+    Durable queue of download jobs in an SQLite file.
+
+    A job holds the form values of one show (spec), a priority and its
+    state: queued -> resolving -> downloading -> done/failed. Workers take
+    the queued job with the highest priority, oldest first. Several server
+    processes can share one queue: a job is claimed by the process whose
+    update moves it out of queued, and it records that process as its
+    owner (host:pid). Jobs that were resolving or downloading when their
+    process ended are queued again by requeue_interrupted(), their partial
+    downloads resume from disk.
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self._lock = Lock()
+        self._submitted = Condition()
+        if os.path.dirname(file_name):
+            os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        self._connection = sqlite3.connect(file_name, timeout=30, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(SCHEMA)
+        # queues written before jobs had an owner
+        columns = [row[1] for row in self._connection.execute("PRAGMA table_info(jobs)")]
+        if "owner" not in columns:
+            with self._connection:
+                self._connection.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+
+    def _job(self, row):
+        if row is None:
+            return None
+        job = dict(row)
+        job["spec"] = json.loads(job["spec"])
+        return job
+
+    def submit(self, spec, priority=0):
+        """Queue spec and return the id of the new job."""
+        with self._lock, self._connection:
+            job_id = self._connection.execute(
+                "INSERT INTO jobs (spec, priority, state, created) VALUES (?, ?, ?, ?)",
+                (json.dumps(spec), int(priority), QUEUED, time.time())).lastrowid
+        logger.info(f"Queued job {job_id} with priority {priority}: {spec}")
+        with self._submitted:
+            self._submitted.notify()
+        return job_id
+
+    def claim(self):
+        """Mark the next queued job as resolving by this process and return it, or None if there is none."""
+        with self._lock:
+            while True:
+                with self._connection:
+                    row = self._connection.execute(
+                        "SELECT id FROM jobs WHERE state = ? ORDER BY priority DESC, id LIMIT 1", (QUEUED,)).fetchone()
+                    if row is None:
+                        return None
+                    # another process may have claimed it since the select, then the next one is tried
+                    claimed = self._connection.execute(
+                        "UPDATE jobs SET state = ?, owner = ?, started = ?, attempts = attempts + 1, message = NULL "
+                        "WHERE id = ? AND state = ?",
+                        (RESOLVING, self.owner, time.time(), row["id"], QUEUED)).rowcount
+                if claimed:
+                    return self._job(self._connection.execute("SELECT * FROM jobs WHERE id = ?",
+                                                              (row["id"],)).fetchone())
+
+    def wait(self, timeout):
+        """Wait until a job is submitted in this process, at most timeout seconds."""
+        with self._submitted:
+            self._submitted.wait(timeout)
+
+    def set_state(self, job_id, state, message=None):
+        if state not in JOB_STATES:
+            raise ValueError(f"Unknown job state '{state}'.")
+        finished = time.time() if state in (DONE, FAILED) else None
+        with self._lock, self._connection:
+            self._connection.execute("UPDATE jobs SET state = ?, message = ?, finished = ? WHERE id = ?",
+                                     (state, message, finished, job_id))
+
+    def set_priority(self, job_id, priority):
+        """Change the priority of a job. Returns False if there is no such job."""
+        with self._lock, self._connection:
+            return self._connection.execute("UPDATE jobs SET priority = ? WHERE id = ?",
+                                            (int(priority), job_id)).rowcount > 0
+
+    def cancel(self, job_id):
+        """Mark a queued job as failed. Returns False if it is not queued (any more)."""
+        with self._lock, self._connection:
+            return self._connection.execute("UPDATE jobs SET state = ?, message = ?, finished = ? "
+                                            "WHERE id = ? AND state = ?",
+                                            (FAILED, "cancelled", time.time(), job_id, QUEUED)).rowcount > 0
+
+    def requeue_interrupted(self):
+        """
+        Queue the jobs that were being worked on by a process that is gone.
+        Jobs of processes still running on this host are left to them, and
+        so are jobs of other hosts, whose processes can't be checked from
+        here. Returns the number of requeued jobs.
+        """
+        placeholders = ", ".join("?" * len(ACTIVE_STATES))
+        host = socket.gethostname()
+        count = 0
+        with self._lock, self._connection:
+            for row in self._connection.execute(f"SELECT id, owner FROM jobs WHERE state IN ({placeholders})",
+                                                ACTIVE_STATES).fetchall():
+                owner_host, _, owner_pid = (row["owner"] or "").rpartition(":")
+                # an owner equal to this process is an earlier one that had the same pid, this one runs nothing yet
+                if row["owner"] and row["owner"] != self.owner:
+                    if owner_host != host:
+                        logger.info(f"Job {row['id']} is running on {owner_host}, leaving it there.")
+                        continue
+                    if not owner_pid.isdigit() or process_alive(int(owner_pid)):
+                        logger.debug(f"Job {row['id']} is still running in process {owner_pid}.")
+                        continue
+                # state is checked again, the owner may have finished the job meanwhile
+                count += self._connection.execute(
+                    f"UPDATE jobs SET state = ?, owner = NULL, message = ? WHERE id = ? AND state IN ({placeholders})",
+                    (QUEUED, "resumed after restart", row["id"], *ACTIVE_STATES)).rowcount
+        if count:
+            logger.info(f"Resuming {count} interrupted job(s).")
+        return count
+
+    def get(self, job_id):
+        with self._lock:
+            return self._job(self._connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def jobs(self, limit=100):
+        """Unfinished jobs in the order they will run, followed by the most recently finished ones."""
+        placeholders = ", ".join("?" * len(ACTIVE_STATES))
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT * FROM jobs ORDER BY state IN ({placeholders}) DESC, state = ? DESC, "
+                f"CASE WHEN state = ? THEN -priority ELSE 0 END, COALESCE(finished, 0) DESC, id LIMIT ?",
+                (*ACTIVE_STATES, QUEUED, QUEUED, limit)).fetchall()
+        return [self._job(row) for row in rows]
+
+# ------------------------------------------------------- #
+#                      functions
+# ------------------------------------------------------- #
+
+
+def process_alive(pid):
+    """Whether a process with pid runs on this machine."""
+    if os.name == "nt":
+        # os.kill would terminate the process on Windows
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+        if not handle:
+            return False
+        try:
+            exit_code = ctypes.c_ulong()
+            return bool(kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code))) and \
+                exit_code.value == STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # exists, but belongs to another user
+        return True
+    return True
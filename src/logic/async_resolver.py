@@ -0,0 +1,80 @@
+import asyncio
+from urllib.parse import urlparse
+
+from src.constants import resolve_connections_per_host
+from src.custom_logging import setup_logger
+from src.logic import offer_stream
+from src.logic.language import ProviderError
+from src.logic.search_for_links import candidates_from_offers, resolve_candidates
+
+logger = setup_logger(__name__)
+
+# ------------------------------------------------------- #
+#                      classes
+# ------------------------------------------------------- #
+
+
+class AsyncResolver:
+    """
+    Resolves many episodes at once on an asyncio event loop.
+
+    The blocking page fetches and the hedged stream url resolution run in
+    worker threads, at most resolve_connections_per_host at a time per host.
+    Episode pages are parsed in those threads while they arrive, or in the
+    parse process pool, so parsing never holds up the loop. Create and use
+    it inside one running event loop.
+    """
+
+    def __init__(self, per_host=resolve_connections_per_host):
+        self.per_host = max(1, per_host)
+        self._semaphores = {}
+
+    def _semaphore(self, url):
+        host = urlparse(url).hostname
+        if host not in self._semaphores:
+            self._semaphores[host] = asyncio.Semaphore(self.per_host)
+        return self._semaphores[host]
+
+    async def offers(self, internal_link):
+        """OfferTable of the episode page."""
+        async with self._semaphore(internal_link):
+            return await asyncio.to_thread(offer_stream.fetch_offers, internal_link)
+
+    async def candidates(self, site_url, internal_link, language, provider):
+        """
+        Offers of the episode in scoreboard order: [(link_to_redirect, provider, lang_key)].
+        Raises LanguageError when the page has offers, but not in language.
+        """
+        return candidates_from_offers(site_url, await self.offers(internal_link), language, provider)
+
+    async def resolve(self, site_url, internal_link, language, provider):
+        """
+        Resolve the episode to a downloadable stream url, trying the providers in
+        scoreboard order: (cache_url, provider, lang_key, link_to_redirect).
+        Raises LanguageError when the episode is not offered in language,
+        ProviderError when no provider delivers it.
+        """
+        candidates = await self.candidates(site_url, internal_link, language, provider)
+        if not candidates:
+            raise ProviderError(f"No provider offers {internal_link} in '{language}'.")
+        async with self._semaphore(candidates[0][0]):
+            return await asyncio.to_thread(resolve_candidates, internal_link, candidates)
+
+# ------------------------------------------------------- #
+#                      functions
+# ------------------------------------------------------- #
+
+
+def resolve_streams(site_url, internal_links, language, provider):
+    """
+    Resolve every episode of internal_links concurrently. Returns a list in
+    the same order holding (cache_url, provider, lang_key, link_to_redirect)
+    or the exception that episode failed with.
+    """
+    async def resolve_all():
+        resolver = AsyncResolver()
+        return await asyncio.gather(*(resolver.resolve(site_url, link, language, provider) for link in internal_links),
+                                    return_exceptions=True)
+
+    logger.debug(f"Resolving {len(internal_links)} episode(s) concurrently.")
+    return asyncio.run(resolve_all())
@@ -1,60 +1,163 @@
-import urllib.request
+import re
 
 from bs4 import BeautifulSoup
 
 from src.custom_logging import setup_logger
+from src.logic import page_cache, parse_pool
 
 logger = setup_logger(__name__)
 
-
-def get_season(url_path):
-    logger.debug("Entered get_season.")
-    logger.debug("Site URL is: " + url_path)
-    counter_seasons = 1
-    html_page = urllib.request.urlopen(url_path, timeout=50)
-    soup = BeautifulSoup(html_page, features="html.parser")
-    for link in soup.findAll('a'):
-        seasons = str(link.get("href"))
-        if "/staffel-{}".format(counter_seasons) in seasons:
-            counter_seasons = counter_seasons + 1
-    logger.debug("Now leaving Function get_season")
-    return counter_seasons - 1
-
-
-def get_episodes(url_path, season_count):
-    logger.debug("Entered get_episodes")
-    url = "{}staffel-{}/".format(url_path, season_count)
-    episode_count = 1
-    with urllib.request.urlopen(url, timeout=50) as response:
-        html_content = response.read()
-    soup = BeautifulSoup(html_content, 'html.parser')
-    for link in soup.findAll('a'):
-        episode = str(link.get("href"))
-        if "/staffel-{}/episode-{}".format(season_count, episode_count) in episode:
-            episode_count = episode_count + 1
-    logger.debug("Now leaving Function get_episodes")
-    return episode_count - 1
-
-
-def get_movies(url_path):
-    logger.debug("Entered get_movies")
-    url = "{}filme/".format(url_path)
-    movie_count = 1
-    with urllib.request.urlopen(url, timeout=50) as response:
-        html_content = response.read()
-    soup = BeautifulSoup(html_content, 'html.parser')
-    for link in soup.findAll('a'):
-        movie = str(link.get("href"))
-        if "/filme/film-{}".format(movie_count) in movie:
-            movie_count = movie_count + 1
-    logger.debug("Now leaving Function get_movies")
-    return movie_count - 1
+# ------------------------------------------------------- #
+#                   global variables
+# ------------------------------------------------------- #
+ANCHOR_PATTERN = re.compile(
+    r"/(?:staffel-(?P<season>\d+)(?:/episode-(?P<episode>\d+))?|filme(?:/film-(?P<movie>\d+))?)/?(?:[?#].*)?$"
+)
 
 # ------------------------------------------------------- #
-#                      classes
+#                      functions
 # ------------------------------------------------------- #
 
 
+def parse_listing(soup, slug):
+    """
+    Walk every anchor of a page once and collect what it links to of the show
+    named slug: season numbers, {season: {episode: title}}, {movie: title} and
+    whether a movie page exists.
+    """
+    seasons = set()
+    episodes = {}
+    movies = {}
+    has_movies = False
+    for link in soup.find_all("a", href=True):
+        href = link["href"]
+        if f"/{slug}/" not in href:
+            continue
+        match = ANCHOR_PATTERN.search(href)
+        if not match:
+            continue
+        title = link.get("title") or link.get_text(" ", strip=True)
+        if title.isdigit() or "→" in title or "←" in title:
+            # episode number tabs and previous/next navigation
+            title = None
+        if match.group("episode"):
+            season_titles = episodes.setdefault(int(match.group("season")), {})
+            if not season_titles.get(int(match.group("episode"))):
+                season_titles[int(match.group("episode"))] = title or ""
+        elif match.group("season"):
+            seasons.add(int(match.group("season")))
+        elif match.group("movie"):
+            if not movies.get(int(match.group("movie"))):
+                movies[int(match.group("movie"))] = title or ""
+        else:
+            has_movies = True
+    return seasons, episodes, movies, has_movies or bool(movies)
+
+
+def parse_year(soup):
+    # Version 1: Alte Struktur mit itemprop
+    year_old = soup.find("span", {"itemprop": "startDate"})
+    if year_old:
+        logger.debug("Alte Struktur gefunden")
+        return year_old.text.strip()
+
+    # Version 2: Neue Struktur
+    year_element = soup.find("p", class_="small text-muted mb-2")
+    if year_element and year_element.find("a"):
+        logger.debug("Neue Struktur gefunden")
+        return year_element.find("a").text.strip()
+
+    # Version 3: Alternative Suche in der neuen Struktur
+    year_element = soup.find("div", class_="col-12 col-md-9 col-lg-10")
+    if year_element and year_element.find("a", class_="small text-muted"):
+        logger.debug("Alternative neue Struktur gefunden")
+        return year_element.find("a", class_="small text-muted").text.strip()
+
+    logger.debug("Kein Jahr gefunden")
+    return None
+
+
+def parse_title(soup):
+    heading = soup.find("h1")
+    return heading.get_text(" ", strip=True) if heading else None
+
+
+def summarize_page(html, slug):
+    """
+    Parse a series, season or movie page once and return only what the index
+    needs: parse_listing's result plus year and title. Runs in the parse pool.
+    """
+    soup = BeautifulSoup(html, features="html.parser")
+    return (*parse_listing(soup, slug), parse_year(soup), parse_title(soup))
+
+
+def count_contiguous(numbers):
+    """Count 1, 2, 3, ... until the first gap, like the site numbers seasons and episodes."""
+    count = 0
+    while count + 1 in numbers:
+        count += 1
+    return count
+
 # ------------------------------------------------------- #
-#                       main
+#                      classes
 # ------------------------------------------------------- #
+
+
+class SeriesIndex:
+    """
+    Structured model of one show built from as few page fetches as possible.
+
+    The series page is fetched and parsed once for seasons, year and title.
+    Season pages and the movie page are fetched on first use and kept, the
+    movie page only if the series page links to it at all.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.slug = url.rstrip("/").rsplit("/", 1)[-1]
+        logger.debug("Building series index for " + url)
+        seasons, self._episodes, _, self._has_movies, self.year, self.title = parse_pool.parse(
+            summarize_page, page_cache.get_page(url), self.slug)
+        self.season_numbers = sorted(seasons)
+        self.season_count = count_contiguous(seasons)
+        self._loaded_seasons = set()
+        self._movies = None
+        logger.debug(f"{self.slug}: {self.season_count} season(s), year {self.year}, movies: {self._has_movies}")
+
+    def _season_titles(self, season):
+        if season not in self._loaded_seasons:
+            _, episodes, _, _, _, _ = parse_pool.parse(
+                summarize_page, page_cache.get_page("{}staffel-{}/".format(self.url, season)), self.slug)
+            self._episodes[season] = episodes.get(season, {})
+            self._loaded_seasons.add(season)
+        return self._episodes[season]
+
+    def episodes(self, season):
+        """Episode numbers of season, in order."""
+        titles = self._season_titles(season)
+        return list(range(1, count_contiguous(titles) + 1))
+
+    def episode_count(self, season):
+        return len(self.episodes(season))
+
+    def episode_title(self, season, episode):
+        return self._season_titles(season).get(episode) or None
+
+    def _movie_titles(self):
+        if self._movies is None:
+            if self._has_movies:
+                _, _, self._movies, _, _, _ = parse_pool.parse(
+                    summarize_page, page_cache.get_page("{}filme/".format(self.url)), self.slug)
+            else:
+                self._movies = {}
+        return self._movies
+
+    def movies(self):
+        """Movie/special numbers, in order."""
+        return list(range(1, count_contiguous(self._movie_titles()) + 1))
+
+    def movie_count(self):
+        return len(self.movies())
+
+    def movie_title(self, movie):
+        return self._movie_titles().get(movie) or None
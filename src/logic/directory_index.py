@@ -0,0 +1,97 @@
+import os
+from threading import Lock
+
+from src.custom_logging import setup_logger
+from src.logic.library import get_manifest, manifest_for
+
+logger = setup_logger(__name__)
+
+# ------------------------------------------------------- #
+#                      functions
+# ------------------------------------------------------- #
+
+
+def normalize_filename(filename):
+    """Normalize filename by removing hyphens and spaces for comparison purposes."""
+    return filename.replace("-", "").replace(" ", "")
+
+# ------------------------------------------------------- #
+#                      classes
+# ------------------------------------------------------- #
+
+
+class DirectoryIndex:
+    """
+    Per-run map of normalized file name -> (path, size) for every directory
+    that was looked into. Each directory is listed once, so checking
+    hundreds of episodes of a season folder on network storage costs one
+    listing instead of one per episode, or none at all when the library
+    manifest knows the directory is unchanged. Finished downloads are
+    added by the downloader, so the map stays valid for the whole run.
+    """
+
+    def __init__(self):
+        self._directories = {}
+        self._lock = Lock()
+
+    def _listing(self, dir_name):
+        """(name, size) of every file in dir_name, from the library manifest when the directory is part of it."""
+        manifest = manifest_for(dir_name) or get_manifest()
+        files = manifest.files(dir_name) if manifest else None
+        if files is not None:
+            return files.items()
+        files = []
+        try:
+            with os.scandir(dir_name) as iterator:
+                for entry in iterator:
+                    try:
+                        if entry.is_file():
+                            files.append((entry.name, entry.stat().st_size))
+                    except OSError:
+                        # file may have been deleted while listing
+                        continue
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.debug(f"Could not access directory {dir_name}: {e}")
+        return files
+
+    def _scan(self, dir_name):
+        entries = {}
+        for name, size in self._listing(dir_name):
+            key = normalize_filename(name)
+            # the hyphen and space variants of a name share a key, prefer one with content
+            if key not in entries or not entries[key][1]:
+                entries[key] = (os.path.join(dir_name, name), size)
+        logger.debug(f"Indexed {len(entries)} file(s) in {dir_name}.")
+        return entries
+
+    def _entries(self, dir_name):
+        with self._lock:
+            if dir_name not in self._directories:
+                self._directories[dir_name] = self._scan(dir_name)
+            return self._directories[dir_name]
+
+    def clear(self):
+        """Forget every listing, the next lookups see the disk as it is now."""
+        with self._lock:
+            self._directories.clear()
+
+    def lookup(self, file_name):
+        """(path, size) of the file matching file_name ignoring hyphens and spaces, or None."""
+        dir_name, base_name = os.path.split(os.path.normpath(file_name))
+        return self._entries(dir_name).get(normalize_filename(base_name))
+
+    def add(self, file_name):
+        """Record a file that was just written."""
+        dir_name, base_name = os.path.split(os.path.normpath(file_name))
+        try:
+            size = os.path.getsize(file_name)
+        except OSError:
+            return
+        entries = self._entries(dir_name)
+        with self._lock:
+            entries[normalize_filename(base_name)] = (file_name, size)
+
+
+directory_index = DirectoryIndex()
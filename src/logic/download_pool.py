@@ -0,0 +1,165 @@
+from collections import deque
+from concurrent.futures import Future, wait
+from threading import Condition, Thread, local
+
+from src.custom_logging import setup_logger
+
+logger = setup_logger(__name__)
+
+# ------------------------------------------------------- #
+#                   definitions
+# ------------------------------------------------------- #
+# key of a worker that holds no slot, None is a valid key
+NO_SLOT = object()
+
+# ------------------------------------------------------- #
+#                      classes
+# ------------------------------------------------------- #
+
+
+class DownloadPool:
+    """
+    Download workers fed from one bounded queue per key (the provider of the
+    episode). configure() resizes a running pool.
+
+    A key may have its own limit of concurrently running jobs. A free worker
+    takes the next job of the first key, in round-robin order, that is below
+    its limit, so a full VOE queue waiting for a VOE slot does not hold back
+    Streamtape jobs that could start right away.
+
+    A job holds the running slot of its key from the moment a worker takes
+    it. A job that ends up working for another key (an episode that falls
+    back to another provider) moves its slot there with move_slot().
+
+    submit() blocks the producer while the queue of its key is full, so at
+    most workers + queue_size episodes per key are in flight at any time.
+    """
+
+    def __init__(self, workers, queue_size, limits=None):
+        self.workers = 0
+        self.queue_size = 1
+        # key -> max. running jobs, 0 or missing = only bounded by the number of workers
+        self.limits = {}
+        self._pending = {}
+        self._running = {}
+        self._next_key = 0
+        self._futures = []
+        self._condition = Condition()
+        self._alive = 0
+        # key whose slot the job of a worker thread holds
+        self._worker_state = local()
+        self._started = 0
+        self.configure(workers, queue_size, limits)
+
+    def configure(self, workers, queue_size, limits=None):
+        """
+        Change the number of workers, the queue size and the limits of a
+        running pool. Surplus workers exit once their current job finished.
+        """
+        with self._condition:
+            workers, queue_size, limits = max(1, int(workers)), max(1, int(queue_size)), dict(limits or {})
+            if (workers, queue_size, limits) == (self.workers, self.queue_size, self.limits):
+                return
+            self.workers, self.queue_size, self.limits = workers, queue_size, limits
+            while self._alive < self.workers:
+                self._alive += 1
+                self._started += 1
+                Thread(target=self._worker, name=f"download-{self._started}", daemon=True).start()
+            # wakes blocked submits for a larger queue and idle workers that are no longer needed
+            self._condition.notify_all()
+        logger.debug(f"Download pool set to {self.workers} worker(s), a queue of {self.queue_size} per "
+                     f"provider and limits {self.limits}.")
+
+    def submit(self, func, *args, key=None) -> Future:
+        future = Future()
+        with self._condition:
+            jobs = self._pending.setdefault(key, deque())
+            # blocks while the queue of this key is full (backpressure on the producer)
+            while len(jobs) >= self.queue_size:
+                self._condition.wait()
+            jobs.append((future, func, args))
+            self._futures.append(future)
+            self._condition.notify_all()
+        return future
+
+    def wait(self):
+        """Block until every job submitted so far has finished."""
+        with self._condition:
+            futures = list(self._futures)
+            self._futures.clear()
+        wait(futures)
+
+    def move_slot(self, key):
+        """
+        Count the job of the calling worker against key instead of the key it
+        was queued under, waiting while key is at its limit. Returns True if
+        it had to wait. Does nothing outside of the pool's workers.
+        """
+        current = getattr(self._worker_state, "key", NO_SLOT)
+        if current is NO_SLOT or current == key:
+            return False
+        waited = False
+        with self._condition:
+            # the old slot is given up first, two jobs moving towards each other's key must not block each other
+            self._running[current] -= 1
+            self._worker_state.key = NO_SLOT
+            self._condition.notify_all()
+            while not self._has_capacity(key):
+                waited = True
+                self._condition.wait()
+            self._running[key] = self._running.get(key, 0) + 1
+            self._worker_state.key = key
+        return waited
+
+    def _has_capacity(self, key):
+        limit = self.limits.get(key) or 0
+        return limit <= 0 or self._running.get(key, 0) < limit
+
+    def _take_job(self):
+        """Pop the next runnable job round-robin over the keys. Call with the condition held."""
+        keys = list(self._pending)
+        for offset in range(len(keys)):
+            key = keys[(self._next_key + offset) % len(keys)]
+            if self._pending[key] and self._has_capacity(key):
+                self._next_key = (self._next_key + offset + 1) % len(keys)
+                self._running[key] = self._running.get(key, 0) + 1
+                # a queue slot became free for a blocked submit()
+                self._condition.notify_all()
+                return key, self._pending[key].popleft()
+        return None
+
+    def _retire(self):
+        """True if the calling worker is no longer needed and should exit. Call with the condition held."""
+        if self._alive > self.workers:
+            self._alive -= 1
+            return True
+        return False
+
+    def _worker(self):
+        while True:
+            with self._condition:
+                if self._retire():
+                    return
+                job = self._take_job()
+                while job is None:
+                    self._condition.wait()
+                    if self._retire():
+                        return
+                    job = self._take_job()
+            key, (future, func, args) = job
+            self._worker_state.key = key
+            try:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    future.set_result(func(*args))
+                except BaseException as e:
+                    logger.error(f"Download job failed: {e}")
+                    future.set_exception(e)
+            finally:
+                with self._condition:
+                    # the job may have moved its slot to another key
+                    if self._worker_state.key is not NO_SLOT:
+                        self._running[self._worker_state.key] -= 1
+                    self._worker_state.key = NO_SLOT
+                    self._condition.notify_all()
@@ -1,52 +1,88 @@
+import json
 import os
 import platform
+import re
+import shutil
 import subprocess
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from os import path
-from threading import Thread
+from threading import Lock
 
 import requests
 
+from src.constants import (download_limits, download_queue_size, download_segments, hls_segment_workers,
+                           max_download_threads)
 from src.custom_logging import setup_logger
+from src.logic.directory_index import directory_index
+from src.logic.download_pool import DownloadPool
+from src.logic import transport
+from src.logic.library import get_manifest, manifest_for
+from src.logic.hls import FFMPEG_SPOOL_INPUT_ARGS, HlsError, fetch_hls_to_spool
+from src.logic.provider_scoreboard import scoreboard
+from src.logic.language import ProviderError
+from src.logic.retry import download_policy, is_retryable
+from src.logic.search_for_links import find_cache_url, resolve_candidates
 from src.failures import append_failure, remove_file
 from src.successes import append_success
 
 logger = setup_logger(__name__)
 
+download_pool = None
+download_pool_lock = Lock()
 
-def normalize_filename(filename):
-    """Normalize filename by removing hyphens and spaces for comparison purposes."""
-    return filename.replace("-", "").replace(" ", "")
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+SUPPORTED_PROVIDERS = ["VOE", "Vidoza", "Streamtape"]
+# answers of CDNs whose signed stream url expired
+EXPIRED_STATUS_CODES = {403, 410}
+CONTENT_RANGE_PATTERN = re.compile(r"bytes (?P<start>\d+)-\d+/(?P<total>\d+|\*)")
+
+
+# ------------------------------------------------------- #
+#                      classes
+# ------------------------------------------------------- #
+
+
+class Transfer:
+    """Bytes and time to first byte of one download attempt, reported to the provider scoreboard."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.size = 0
+        self.ttfb = None
+        self._lock = Lock()
+
+    def response(self, r):
+        with self._lock:
+            if self.ttfb is None:
+                self.ttfb = r.elapsed.total_seconds()
+
+    def add(self, size):
+        with self._lock:
+            self.size += size
+
+    def record(self, provider):
+        if provider:
+            scoreboard.record_download(provider, self.ttfb, self.size, time.monotonic() - self.started)
+
+
+# ------------------------------------------------------- #
+#                      functions
+# ------------------------------------------------------- #
 
 
 def find_file_ignore_hyphens(file_name):
     """Check if file exists, also checking for variations without hyphens."""
-    # First check exact match
-    if os.path.exists(file_name) and os.path.getsize(file_name) > 0:
+    match = directory_index.lookup(file_name)
+    if match is None:
+        return False
+    if match[1] > 0:
         return True
-    
-    # Check directory-based variations (for folder structure)
-    dir_name = os.path.dirname(file_name)
-    base_name = os.path.basename(file_name)
-    
-    if os.path.exists(dir_name):
-        # Normalize the base filename for comparison
-        normalized_base = normalize_filename(base_name)
-        try:
-            for existing_file in os.listdir(dir_name):
-                if normalize_filename(existing_file) == normalized_base:
-                    full_path = os.path.join(dir_name, existing_file)
-                    try:
-                        if os.path.getsize(full_path) > 0:
-                            return True
-                    except OSError:
-                        # File may have been deleted between listdir and getsize
-                        continue
-        except (PermissionError, FileNotFoundError, OSError) as e:
-            logger.debug(f"Could not access directory {dir_name}: {e}")
-            return False
-    
-    return False
+    # the listing may predate the file being written in place, check this one file before downloading it again
+    try:
+        return path.getsize(match[0]) > 0
+    except OSError:
+        return False
 
 
 def already_downloaded(file_name):
@@ -58,31 +94,244 @@ def already_downloaded(file_name):
     return False
 
 
-def download(link, file_name):
-    retry_count = 0
-    while True:
-        logger.debug("Entered download with these vars: Link: {}, File_Name: {}".format(link, file_name))
-        r = requests.get(link, stream=True)
-        with open(file_name, 'wb') as f:
-            for chunk in r.iter_content(1024):
+def read_part_meta(meta_file):
+    try:
+        with open(meta_file, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_part_meta(meta_file, meta):
+    with open(meta_file, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+
+
+def parse_content_range(content_range):
+    """Return (start, total) of a 'bytes start-end/total' header or None."""
+    match = CONTENT_RANGE_PATTERN.match(content_range or "")
+    if not match:
+        return None
+    total = match.group("total")
+    return int(match.group("start")), int(total) if total != "*" else None
+
+
+def fetch_to_part_file(link, part_file, meta_file, transfer=None):
+    """
+    Download link into part_file, resuming from its current size when the
+    server supports ranges and the stored ETag/Content-Length still match.
+    Returns True once the part file holds the complete content.
+    """
+    meta = read_part_meta(meta_file)
+    # a segmented part file is preallocated, its size says nothing about the progress
+    offset = path.getsize(part_file) if path.exists(part_file) and meta and not meta.get("segments") else 0
+    headers = dict(transport.MEDIA_HEADERS)
+    if offset:
+        headers["Range"] = "bytes={}-".format(offset)
+        validator = meta.get("etag") or meta.get("last_modified")
+        if validator:
+            headers["If-Range"] = validator
+
+    with transport.get(link, rate_limited=False, stream=True, headers=headers) as r:
+        if transfer:
+            transfer.response(r)
+        if r.status_code == 416 and offset and offset == meta.get("length"):
+            return True
+        r.raise_for_status()
+
+        mode = "wb"
+        if r.status_code == 206 and offset:
+            content_range = parse_content_range(r.headers.get("Content-Range"))
+            if content_range and content_range[0] == offset and content_range[1] == meta.get("length"):
+                logger.info("Resuming download of {} at {} bytes.".format(part_file, offset))
+                mode = "ab"
+            else:
+                logger.info("Partial download {} does not match the server file. Starting over.".format(part_file))
+                r.close()
+                os.remove(part_file)
+                os.remove(meta_file)
+                return fetch_to_part_file(link, part_file, meta_file, transfer)
+        else:
+            content_length = r.headers.get("Content-Length")
+            meta = {
+                "etag": r.headers.get("ETag"),
+                "last_modified": r.headers.get("Last-Modified"),
+                "length": int(content_length) if content_length and content_length.isdigit() else None,
+            }
+            write_part_meta(meta_file, meta)
+
+        with open(part_file, mode) as f:
+            for chunk in r.iter_content(DOWNLOAD_CHUNK_SIZE):
                 f.write(chunk)
-        if path.getsize(file_name) != 0:
-            logger.success("Finished download of {}.".format(file_name))
-            append_success(file_name)
-            break
-        elif retry_count == 1:
+                if transfer:
+                    transfer.add(len(chunk))
+
+    size = path.getsize(part_file)
+    if meta.get("length"):
+        return size == meta["length"]
+    return size != 0
+
+
+def probe_range_support(link):
+    """Return (length, etag, last_modified) if the server serves byte ranges, else None."""
+    with transport.get(link, rate_limited=False, stream=True,
+                       headers={**transport.MEDIA_HEADERS, "Range": "bytes=0-0"}) as r:
+        if r.status_code != 206:
+            return None
+        content_range = parse_content_range(r.headers.get("Content-Range"))
+        if not content_range or not content_range[1]:
+            return None
+        return content_range[1], r.headers.get("ETag"), r.headers.get("Last-Modified")
+
+
+def fetch_segment(link, part_file, segment, validator, transfer=None):
+    start, end = segment["start"], segment["end"]
+    headers = {**transport.MEDIA_HEADERS, "Range": "bytes={}-{}".format(start, end)}
+    if validator:
+        headers["If-Range"] = validator
+    with transport.get(link, rate_limited=False, stream=True, headers=headers) as r:
+        r.raise_for_status()
+        if transfer:
+            transfer.response(r)
+        content_range = parse_content_range(r.headers.get("Content-Range"))
+        if r.status_code != 206 or not content_range or content_range[0] != start:
+            raise requests.RequestException("Server did not honour the range {}-{}.".format(start, end))
+        expected = end - start + 1
+        written = 0
+        with open(part_file, "r+b") as f:
+            f.seek(start)
+            for chunk in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+                # never write past the segment, even if the server sends more
+                chunk = chunk[:expected - written]
+                f.write(chunk)
+                written += len(chunk)
+                if transfer:
+                    transfer.add(len(chunk))
+                if written == expected:
+                    break
+    if written != expected:
+        raise requests.RequestException("Segment {}-{} is incomplete.".format(start, end))
+
+
+def fetch_segmented_to_part_file(link, part_file, meta_file, segment_count, transfer=None):
+    """
+    Download link with segment_count parallel range requests written straight
+    into their offsets of a preallocated part_file. Finished segments are
+    recorded in the sidecar so a restart only fetches the missing ones.
+    Returns None if the server does not support ranges.
+    """
+    meta = read_part_meta(meta_file)
+    probe = probe_range_support(link)
+    if probe is None:
+        return None
+    length, etag, last_modified = probe
+    if meta.get("segments") and path.exists(part_file) and (meta["length"], meta["etag"]) != (length, etag):
+        logger.info("Partial download {} does not match the server file. Starting over.".format(part_file))
+        meta = {}
+    if not (meta.get("segments") and path.exists(part_file)):
+        segment_size = -(-length // segment_count)
+        meta = {
+            "etag": etag,
+            "last_modified": last_modified,
+            "length": length,
+            "segments": [{"start": start, "end": min(start + segment_size, length) - 1, "done": False}
+                         for start in range(0, length, segment_size)],
+        }
+        with open(part_file, "wb") as f:
+            f.truncate(length)
+        write_part_meta(meta_file, meta)
+
+    validator = meta.get("etag") or meta.get("last_modified")
+    pending = [segment for segment in meta["segments"] if not segment["done"]]
+    logger.debug("Fetching {} of {} segments for {}.".format(len(pending), len(meta["segments"]), part_file))
+    meta_lock = Lock()
+
+    def run(segment):
+        fetch_segment(link, part_file, segment, validator, transfer)
+        with meta_lock:
+            segment["done"] = True
+            write_part_meta(meta_file, meta)
+
+    with ThreadPoolExecutor(max_workers=segment_count) as executor:
+        futures = [executor.submit(run, segment) for segment in pending]
+        errors = [future.exception() for future in futures if future.exception()]
+    if errors:
+        raise errors[0]
+    return path.getsize(part_file) == meta["length"]
+
+
+def record_success(file_name, provider):
+    """Announce a finished download and add it to the directory index and the library manifest."""
+    directory_index.add(file_name)
+    manifest = manifest_for(path.dirname(file_name)) or get_manifest()
+    if manifest:
+        manifest.record(file_name, provider)
+    logger.success("Finished download of {}.".format(file_name))
+    append_success(file_name)
+
+
+def is_expired(error):
+    response = getattr(error, "response", None)
+    return response is not None and response.status_code in EXPIRED_STATUS_CODES
+
+
+def download(link, file_name, segment_count=1, provider=None, refresh=None):
+    """
+    Download link to file_name, resuming the .part file on every retry.
+    refresh() is called for a new stream url when the current one expired.
+    Returns True once file_name is complete.
+    """
+    part_file = file_name + ".part"
+    meta_file = part_file + ".json"
+    for attempt in range(1, download_policy.attempts + 1):
+        logger.debug("Entered download with these vars: Link: {}, File_Name: {}".format(link, file_name))
+        transfer = Transfer()
+        retryable = True
+        try:
+            complete = None
+            meta = read_part_meta(meta_file)
+            # a single stream download in progress is continued as a single stream
+            resuming_single_stream = bool(meta) and not meta.get("segments")
+            if segment_count > 1 and not resuming_single_stream:
+                complete = fetch_segmented_to_part_file(link, part_file, meta_file, segment_count, transfer)
+                if complete is None:
+                    logger.debug("Server does not support ranges. Downloading {} in one piece.".format(file_name))
+            if complete is None:
+                complete = fetch_to_part_file(link, part_file, meta_file, transfer)
+        except (requests.RequestException, OSError) as e:
+            logger.warning("Download of {} was interrupted: {}".format(file_name, e))
+            complete = False
+            if refresh and is_expired(e) and attempt < download_policy.attempts:
+                fresh_link = refresh()
+                if fresh_link:
+                    logger.info("Stream url of {} expired. Continuing with a fresh one.".format(file_name))
+                    link = fresh_link
+                    transfer.record(provider)
+                    continue
+            # 404, a full disk and the like won't go away by waiting
+            retryable = is_retryable(e)
+        transfer.record(provider)
+        if complete:
+            os.replace(part_file, file_name)
+            if path.exists(meta_file):
+                os.remove(meta_file)
+            record_success(file_name, provider)
+            return True
+        elif attempt == download_policy.attempts or not retryable:
+            download_policy.give_up()
             logger.error("Server error. Could not download {}. Please manually download it later.".format(file_name))
             append_failure(file_name)
-            remove_file(file_name)
-            break
+            if path.exists(part_file):
+                logger.info("Keeping {} to resume the download on the next run.".format(part_file))
+            return False
         else:
-            logger.info("Download did not complete! File {} will be retryd in a few seconds.".format(file_name))
             logger.debug("URL: {}, filename {}".format(link, file_name))
-            time.sleep(20)
-            retry_count = 1
+            download_policy.wait(attempt, "Download of {} did not complete!".format(file_name))
+    return False
 
 
-def download_and_convert_hls_stream(hls_url, file_name):
+def download_and_convert_hls_stream(hls_url, file_name, provider=None, refresh=None):
+    """Download the HLS stream hls_url and remux it to file_name with ffmpeg. Returns True on success."""
     if path.exists("ffmpeg.exe"):
         ffmpeg_path = "ffmpeg.exe"
     elif path.exists("src/ffmpeg.exe"):
@@ -90,33 +339,140 @@ def download_and_convert_hls_stream(hls_url, file_name):
     else:
         ffmpeg_path = "ffmpeg"
 
+    tmp_file_name = file_name.replace(".mp4", "_tmp.mp4")
+    spool_dir = file_name.replace(".mp4", "_segments")
     try:
-        tmp_file_name = file_name.replace(".mp4", "_tmp.mp4")
         if path.exists(tmp_file_name):
             os.remove(tmp_file_name)
             logger.info("Found broken download. Removed {}.".format(tmp_file_name))
-        ffmpeg_cmd = [ffmpeg_path, '-i', hls_url, '-c', 'copy', tmp_file_name]
+        input_args = ['-i', hls_url]
+        refreshed = False
+        while hls_segment_workers > 0:
+            try:
+                transfer = Transfer()
+                try:
+                    local_playlist = fetch_hls_to_spool(hls_url, spool_dir, hls_segment_workers, transfer)
+                finally:
+                    transfer.record(provider)
+                input_args = FFMPEG_SPOOL_INPUT_ARGS + ['-i', local_playlist]
+            except (HlsError, requests.RequestException, OSError) as e:
+                fresh_url = refresh() if refresh and is_expired(e) and not refreshed else None
+                if fresh_url:
+                    logger.info("Stream url of {} expired. Continuing with a fresh one.".format(file_name))
+                    hls_url, refreshed = fresh_url, True
+                    input_args = ['-i', hls_url]
+                    continue
+                # finished segments stay in the spool so the next run can resume from them
+                logger.warning("Native HLS download of {} failed: {}. Letting ffmpeg fetch the stream.".format(file_name, e))
+            break
+        ffmpeg_cmd = [ffmpeg_path, *input_args, '-c', 'copy', tmp_file_name]
+        # when ffmpeg fetches the stream itself, its run time is the download time
+        ffmpeg_fetches = input_args[:2] == ['-i', hls_url]
+        ffmpeg_started = time.monotonic()
         if platform.system() == "Windows":
             subprocess.run(ffmpeg_cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         else:
             subprocess.run(ffmpeg_cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
         os.rename(tmp_file_name, file_name)
-        logger.success("Finished download of {}.".format(file_name))
-        append_success(file_name)
+        if ffmpeg_fetches and provider:
+            scoreboard.record_download(provider, None, path.getsize(file_name), time.monotonic() - ffmpeg_started)
+        shutil.rmtree(spool_dir, ignore_errors=True)
+        record_success(file_name, provider)
+        return True
     except subprocess.CalledProcessError as e:
         logger.error("Server error. Could not download {}. Please manually download it later.".format(file_name))
         append_failure(file_name)
         remove_file(file_name)
+        # the segments could not be remuxed, don't resume from them
+        shutil.rmtree(spool_dir, ignore_errors=True)
+        return False
 
 
-def create_new_download_thread(url, file_name, provider) -> Thread:
-    logger.debug("Entered Downloader.")
-    t = None
+def get_download_pool(settings=None) -> DownloadPool:
+    """The download pool of the process, resized to the RunSettings settings if given."""
+    global download_pool
+    with download_pool_lock:
+        if download_pool is None:
+            download_pool = DownloadPool(max_download_threads or 1, download_queue_size or max_download_threads or 1,
+                                         download_limits)
+        if settings:
+            download_pool.configure(settings.max_download_threads, settings.download_queue_size,
+                                    settings.download_limits)
+        return download_pool
+
+
+def start_download(url, file_name, provider, refresh=None):
+    """Download url with the downloader for provider in the calling thread. Returns True on success."""
     if provider in ["Vidoza", "Streamtape"]:
-        t = Thread(target=download, args=(url, file_name))
-        t.start()
-    elif provider == "VOE":
-        t = Thread(target=download_and_convert_hls_stream, args=(url, file_name))
-        t.start()
+        return download(url, file_name, download_segments.get(provider, 1), provider, refresh)
+    return download_and_convert_hls_stream(url, file_name, provider, refresh)
+
+
+def queue_download(url, file_name, provider, refresh=None) -> Future:
+    logger.debug("Entered Downloader.")
+    if provider not in SUPPORTED_PROVIDERS:
+        logger.error("Provider {} is not supported for downloading.".format(provider))
+        return None
+    future = get_download_pool().submit(start_download, url, file_name, provider, refresh, key=provider)
     logger.loading("Provider {} - File {} added to queue.".format(provider, file_name))
-    return t
+    return future
+
+
+def download_episode(job, candidates):
+    """
+    Resolve the stream url of job once a worker picked it up and holds a slot
+    of its provider, and download it. Signed stream urls can't expire while
+    the job waits in the queue or for a slot this way, and an url that
+    expires during the download is resolved again.
+    Returns True once the episode is on disk.
+    """
+    done = False
+    try:
+        if job.cancelled:
+            logger.info(f"Not starting {job}, its run was cancelled.")
+            return False
+        try:
+            cache_url, provider, lang_key, redirect_link = resolve_candidates(job.link, candidates)
+        except ProviderError:
+            logger.error(f"Could not find cache url on {job}.")
+            return False
+        logger.debug("{} Cache URL is: ".format(provider) + cache_url)
+        if lang_key != job.series.language:
+            logger.debug(f"Language key {lang_key} does not match requested language {job.series.language}. "
+                         f"Using {lang_key} instead in file name.")
+        file_name = job.file_name(lang_key)
+        logger.info("File name will be: " + file_name)
+        # the limit of the provider actually downloading applies, not the one the job was queued for.
+        # The worker holds the slot of the queued provider already, so the url is resolved under it;
+        # after waiting for the slot of a fallback provider it may have expired and is resolved again.
+        waited = get_download_pool().move_slot(provider)
+        if job.cancelled:
+            logger.info(f"Not starting {job}, its run was cancelled.")
+            return False
+        if waited:
+            cache_url = find_cache_url(redirect_link, provider)
+            if not cache_url:
+                logger.error(f"Could not find cache url on {job}.")
+                return False
+        job.emit("downloading", provider=provider, file_name=file_name)
+        done = start_download(cache_url, file_name, provider, refresh=lambda: find_cache_url(redirect_link, provider))
+        return done
+    finally:
+        job.emit("done" if done else "failed")
+
+
+def queue_episode(job, candidates) -> Future:
+    """
+    Queue job with its provider offers [(link_to_redirect, provider, lang_key)]
+    in the order they should be tried. It waits in the queue of the first one
+    and counts against the limit of the provider it is downloaded from.
+    """
+    provider = candidates[0][1]
+    job.emit("queued", provider=provider)
+    try:
+        future = get_download_pool().submit(download_episode, job, candidates, key=provider)
+    except Exception:
+        job.emit("failed")
+        raise
+    logger.loading("Provider {} - {} added to queue.".format(provider, job))
+    return future
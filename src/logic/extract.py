@@ -0,0 +1,69 @@
+import html
+import re
+
+from src.custom_logging import setup_logger
+
+logger = setup_logger(__name__)
+
+# ------------------------------------------------------- #
+#                   definitions
+# ------------------------------------------------------- #
+COMMENT_PATTERN = re.compile(r"<!--.*?-->", re.DOTALL)
+ATTRIBUTE_PATTERN = re.compile(r"""([^\s=/>"']+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>"']+)))?""")
+MKGMA_PATTERNS = [re.compile(r'MKGMa="(.*?)"', re.DOTALL),
+                  re.compile(r'<script type="application/json">.*\[(.*?)\]</script>', re.DOTALL)]
+
+# ------------------------------------------------------- #
+#                      functions
+# ------------------------------------------------------- #
+# Fast paths over the raw page. Each returns an empty result when it finds
+# nothing, and the callers then fall back to a full BeautifulSoup tree.
+
+
+def to_text(markup):
+    if isinstance(markup, bytes):
+        return markup.decode("utf-8", errors="replace")
+    return markup
+
+
+def start_tags(markup, name):
+    """Attribute dicts of every <name ...> start tag outside of comments, values unescaped."""
+    tag_pattern = re.compile(r"<%s\b((?:[^>\"']|\"[^\"]*\"|'[^']*')*)>" % re.escape(name), re.IGNORECASE)
+    for match in tag_pattern.finditer(COMMENT_PATTERN.sub("", to_text(markup))):
+        attributes = {}
+        for attribute in ATTRIBUTE_PATTERN.finditer(match.group(1)):
+            value = next((group for group in attribute.groups()[1:] if group is not None), "")
+            attributes.setdefault(attribute.group(1).lower(), html.unescape(value))
+        yield attributes
+
+
+def offer_buttons(markup):
+    """
+    Provider buttons of an episode page as {PROVIDER: {language label: (play url, language id)}},
+    read with a regex instead of a parse tree.
+    """
+    buttons = {}
+    for attributes in start_tags(markup, "button"):
+        if "data-provider-name" not in attributes or "data-language-label" not in attributes:
+            continue
+        buttons.setdefault(attributes["data-provider-name"].upper(), {}).setdefault(
+            attributes["data-language-label"], (attributes.get("data-play-url", ""), attributes.get("data-language-id", "")))
+    return buttons
+
+
+def video_source(markup):
+    """src of the first <source> element, or None."""
+    for attributes in start_tags(markup, "source"):
+        if attributes.get("src"):
+            return attributes["src"]
+    return None
+
+
+def mkgma_block(markup):
+    """Obfuscated stream payload of a VOE page, found without building a parse tree, or None."""
+    text = to_text(markup)
+    for pattern in MKGMA_PATTERNS:
+        match = pattern.search(text)
+        if match:
+            return match.group(1)
+    return None
@@ -0,0 +1,184 @@
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from urllib.parse import urlparse
+
+import m3u8
+
+from src.custom_logging import setup_logger
+from src.logic import transport
+from src.logic.retry import download_policy
+
+logger = setup_logger(__name__)
+
+# ------------------------------------------------------- #
+#                   definitions
+# ------------------------------------------------------- #
+LOCAL_PLAYLIST_NAME = "index.m3u8"
+JOURNAL_NAME = "journal.log"
+FFMPEG_SPOOL_INPUT_ARGS = ["-allowed_extensions", "ALL", "-protocol_whitelist", "file,crypto"]
+
+# ------------------------------------------------------- #
+#                      classes
+# ------------------------------------------------------- #
+
+
+class HlsError(Exception):
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+class SegmentJournal:
+    """
+    Append-only record of the spool files that are completely on disk.
+
+    The first line holds the fingerprint of the stream (see
+    stream_fingerprint), every further line "<file name> <size>". A line is
+    only written after its file was moved into place, so a killed process
+    can at worst lose the last entry.
+    """
+
+    def __init__(self, spool_dir, fingerprint):
+        self.path = os.path.join(spool_dir, JOURNAL_NAME)
+        self.done = {}
+        self._lock = Lock()
+        if os.path.exists(self.path):
+            self._load(spool_dir, fingerprint)
+        if not self.done:
+            with open(self.path, "w", encoding="utf-8") as f:
+                f.write(f"#stream {fingerprint}\n")
+
+    def _load(self, spool_dir, fingerprint):
+        with open(self.path, "r", encoding="utf-8") as f:
+            lines = f.read().splitlines()
+        if not lines or lines[0] != f"#stream {fingerprint}":
+            logger.info("HLS journal belongs to a different stream. Starting the download over.")
+            return
+        for line in lines[1:]:
+            parts = line.rsplit(" ", 1)
+            if len(parts) != 2 or not parts[1].isdigit():
+                continue
+            file_path = os.path.join(spool_dir, parts[0])
+            if os.path.exists(file_path) and os.path.getsize(file_path) == int(parts[1]):
+                self.done[parts[0]] = int(parts[1])
+
+    def is_done(self, name):
+        return name in self.done
+
+    def record(self, name, size):
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(f"{name} {size}\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.done[name] = size
+
+
+# ------------------------------------------------------- #
+#                      functions
+# ------------------------------------------------------- #
+
+
+def load_media_playlist(hls_url):
+    """
+    Load hls_url and return (media playlist, its url), following a master
+    playlist to its stream with the highest resolution.
+    """
+    with transport.get(hls_url, rate_limited=False, stream=True) as response:
+        response.raise_for_status()
+        content_type = response.headers.get("Content-Type", "").lower()
+        if "mpegurl" not in content_type and not urlparse(hls_url).path.endswith(".m3u8"):
+            raise HlsError(f"{hls_url} is not an HLS playlist ({content_type}).")
+        playlist = m3u8.loads(response.text, uri=hls_url)
+    if playlist.is_variant:
+        if not playlist.playlists:
+            raise HlsError(f"Master playlist {hls_url} lists no streams.")
+        # the master playlist is parsed already, no need to fetch it again to pick a stream
+        best_stream = max(playlist.playlists, key=lambda variant: variant.stream_info.resolution[1]
+                          if variant.stream_info.resolution else 0)
+        logger.debug(f"Master playlist found. Using {best_stream.stream_info.resolution} stream "
+                     f"{best_stream.absolute_uri}")
+        return load_media_playlist(best_stream.absolute_uri)
+    if not playlist.segments:
+        raise HlsError(f"Playlist {hls_url} contains no segments.")
+    if any(segment.byterange for segment in playlist.segments):
+        raise HlsError("Byte range playlists are not supported by the native HLS downloader.")
+    return playlist, hls_url
+
+
+def without_query(url):
+    # signed CDN urls get new tokens when the stream url is refreshed
+    return url.split("?", 1)[0]
+
+
+def stream_fingerprint(media_url, resource_urls):
+    """Hash of the media playlist url and the urls of every segment, key and init section, ignoring query strings."""
+    digest = hashlib.sha1(without_query(media_url).encode("utf-8"))
+    for url in resource_urls:
+        digest.update(b"\n" + without_query(url).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def local_name(index, remote_url, default_extension):
+    extension = os.path.splitext(urlparse(remote_url).path)[1] or default_extension
+    return f"{index:05d}{extension}"
+
+
+def fetch_resource(remote_url, target_path, transfer=None):
+    """Download one segment/key/init section to target_path, retrying under the download policy."""
+    response = download_policy.call(transport.fetch_once, remote_url, rate_limited=False,
+                                    headers=transport.MEDIA_HEADERS)
+    if transfer:
+        transfer.response(response)
+        transfer.add(len(response.content))
+    tmp_path = target_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(response.content)
+    os.replace(tmp_path, target_path)
+    return os.path.getsize(target_path)
+
+
+def fetch_hls_to_spool(hls_url, spool_dir, workers, transfer=None):
+    """
+    Download every segment of the stream behind hls_url concurrently into
+    spool_dir and write a local playlist that lists them in order. Keys and
+    init sections are fetched as well, so ffmpeg only has to remux local files.
+    Segments already recorded in the spool journal by an earlier, interrupted
+    run are not fetched again. Returns the path of the local playlist.
+    """
+    os.makedirs(spool_dir, exist_ok=True)
+    playlist, media_url = load_media_playlist(hls_url)
+
+    # remote url -> local file name, in playlist order
+    resources = {}
+    for index, segment in enumerate(playlist.segments):
+        resources.setdefault(segment.absolute_uri, local_name(index, segment.absolute_uri, ".ts"))
+    extras = [key for key in playlist.keys if key and key.uri]
+    extras += [segment.init_section for segment in playlist.segments if segment.init_section]
+    extra_urls = [extra.absolute_uri for extra in extras]
+    for url in extra_urls:
+        resources.setdefault(url, f"extra_{len(resources):05d}{os.path.splitext(urlparse(url).path)[1] or '.bin'}")
+
+    journal = SegmentJournal(spool_dir, stream_fingerprint(media_url, resources))
+    missing = {url: name for url, name in resources.items() if not journal.is_done(name)}
+    if len(missing) < len(resources):
+        logger.info(f"Resuming HLS download. {len(resources) - len(missing)} of {len(resources)} files already on disk.")
+
+    def fetch(url, name):
+        journal.record(name, fetch_resource(url, os.path.join(spool_dir, name), transfer))
+
+    logger.info(f"Fetching {len(missing)} HLS files with {workers} connections.")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(fetch, url, name) for url, name in missing.items()]
+        for future in futures:
+            future.result()
+
+    for segment in playlist.segments:
+        segment.uri = resources[segment.absolute_uri]
+    for extra, url in zip(extras, extra_urls):
+        extra.uri = resources[url]
+    playlist_path = os.path.join(spool_dir, LOCAL_PLAYLIST_NAME)
+    with open(playlist_path, "w", encoding="utf-8") as f:
+        f.write(playlist.dumps())
+    return playlist_path
@@ -1,6 +1,7 @@
 from bs4 import BeautifulSoup
 
 from src.custom_logging import setup_logger
+from src.logic import extract
 
 logger = setup_logger(__name__)
 
@@ -111,72 +112,92 @@ def extract_lang_key_mapping(soup):
     return ret
 
 
-def get_href_by_language(html_content, language, provider):
-    soup = BeautifulSoup(html_content, "html.parser")
-    
-    # NEU: Direkte Suche nach dem Button in der neuen Struktur
-    # Das ist der zuverlässigste Weg für die neue Seite
-    direct_buttons = soup.find_all("button", {"data-provider-name": True, "data-language-label": True})
-    for button in direct_buttons:
-        provider_name = button.get("data-provider-name", "")
-        language_label = button.get("data-language-label", "")
-        language_id = button.get("data-language-id", "")
-        play_url = button.get("data-play-url", "")
-        
-        logger.debug(f"Direkter Button - Provider: {provider_name}, Language: {language_label}, ID: {language_id}")
-        
-        # Prüfe ob Provider und Sprache übereinstimmen
-        if provider_name.upper() == provider.upper():
+class OfferTable:
+    """
+    Every stream offer of one episode page, parsed once and indexed by
+    (provider, language) so provider and language fallbacks are plain lookups.
+    """
+
+    def __init__(self, buttons, legacy_languages, legacy_links):
+        # new page structure: {PROVIDER: {language label: (play url, language id)}}
+        self.buttons = buttons
+        # old page structure: {language: lang key} and {(provider, lang key): link target}
+        self.legacy_languages = legacy_languages
+        self.legacy_links = legacy_links
+
+    @classmethod
+    def from_html(cls, html_content):
+        # fast path: the provider buttons of the current page structure, no parse tree needed
+        buttons = extract.offer_buttons(html_content)
+        if buttons:
+            logger.debug(f"Provider buttons found: {', '.join(buttons)}")
+            return cls(buttons, {}, {})
+
+        soup = BeautifulSoup(html_content, "html.parser")
+        for button in soup.find_all("button", {"data-provider-name": True, "data-language-label": True}):
+            provider_name = button.get("data-provider-name", "")
+            language_label = button.get("data-language-label", "")
+            language_id = button.get("data-language-id", "")
+            logger.debug(f"Direkter Button - Provider: {provider_name}, Language: {language_label}, ID: {language_id}")
+            buttons.setdefault(provider_name.upper(), {}).setdefault(
+                language_label, (button.get("data-play-url", ""), language_id))
+
+        legacy_languages = {}
+        legacy_links = {}
+        if not buttons:
+            try:
+                legacy_languages = extract_lang_key_mapping(soup)
+            except Exception as e:
+                logger.error(f"Fehler bei der alten Methode: {e}")
+            for li_element in soup.find_all("li", {"data-lang-key": True}):
+                heading = li_element.find("h4")
+                if heading:
+                    legacy_links.setdefault((heading.get_text(), li_element.get("data-lang-key")),
+                                            li_element.get("data-link-target", ""))
+        return cls(buttons, legacy_languages, legacy_links)
+
+    def find(self, language, provider):
+        """(play url, language) of the offer, or None. Logs only at debug level, for scans over every provider."""
+        # NEU: Direkte Suche nach dem Button in der neuen Struktur
+        provider_offers = self.buttons.get(provider.upper(), {})
+        if language in provider_offers:
+            logger.debug(f"Direkter Button gefunden für {provider} - {language}")
+            return provider_offers[language][0], language
+        for language_label, (play_url, language_id) in provider_offers.items():
             if language_label and language.lower() in language_label.lower():
-                logger.info(f"Direkter Button gefunden für {provider} - {language}")
+                logger.debug(f"Direkter Button gefunden für {provider} - {language}")
                 return play_url, language
             # Fallback: Prüfe über language-id (1 = Deutsch)
             if language_id == "1" and language.lower() == "deutsch":
-                logger.info(f"Direkter Button über ID gefunden für {provider} - {language}")
+                logger.debug(f"Direkter Button über ID gefunden für {provider} - {language}")
                 return play_url, language
-    
-    # Fallback: Alte Methode mit language_mapping
-    try:
-        lang_key_mapping = extract_lang_key_mapping(soup)
-        
-        # Hier musst du prüfen, wie dein language_mapping aussieht
-        # Wahrscheinlich ist es ein Dictionary wie {"Deutsch": "1", "English": "2", ...}
-        filtered_mapping = {}
-        for key, value in lang_key_mapping.items():
-            if language.lower() in key.lower():
-                filtered_mapping[key] = value
-        
-        if not filtered_mapping:
+
+        # Fallback: Alte Methode mit language_mapping
+        filtered_mapping = {key: value for key, value in self.legacy_languages.items()
+                            if language.lower() in key.lower()}
+        if filtered_mapping:
+            # Nimm den ersten passenden Eintrag
+            used_lang, lang_key = next(iter(filtered_mapping.items()))
+            logger.debug(f"Verwende Language Key: {lang_key} für {used_lang}")
+            if (provider, lang_key) in self.legacy_links:
+                return self.legacy_links[(provider, lang_key)], used_lang
+        return None
+
+    def lacks_language(self, language):
+        """Whether the page lists offers but none in language, from any provider."""
+        if not self.buttons and not self.legacy_languages:
+            return False
+        if any(language.lower() in key.lower() for key in self.legacy_languages):
+            return False
+        return all(self.find(language, provider) is None for provider in self.buttons)
+
+    def log_missing(self, language, providers):
+        """Log that none of providers offers language, with what the page offers instead."""
+        if self.legacy_languages and not any(language.lower() in key.lower() for key in self.legacy_languages):
             logger.error(f"Kein Language Mapping für '{language}' gefunden")
-            logger.debug(f"Verfügbare Sprachen: {list(lang_key_mapping.keys())}")
-            raise LanguageError(f"No language mapping found for '{language}'")
-        
-        # Nimm den ersten passenden Eintrag
-        lang_key = list(filtered_mapping.values())[0]
-        used_lang = list(filtered_mapping.keys())[0]
-        
-        logger.debug(f"Verwende Language Key: {lang_key} für {used_lang}")
-        
-        # Alte Struktur: Suche nach li-Elementen
-        matching_li_elements = soup.find_all("li", {"data-lang-key": lang_key})
-        matching_li_element = next((li_element for li_element in matching_li_elements
-                                    if li_element.find("h4") and li_element.find("h4").get_text() == provider), None)
-        
-        if matching_li_element:
-            href = matching_li_element.get("data-link-target", "")
-            return href, used_lang
-            
-    except Exception as e:
-        logger.error(f"Fehler bei der alten Methode: {e}")
-    
-    # Wenn wir hier ankommen, wurde nichts gefunden
-    logger.error(f"Kein passender Download für Sprache '{language}' und Provider '{provider}' gefunden")
-    
-    # Debug: Zeige alle gefundenen Provider und Sprachen
-    all_buttons = soup.find_all("button", {"data-provider-name": True})
-    for button in all_buttons:
-        logger.debug(f"Verfügbarer Button - Provider: {button.get('data-provider-name')}, "
-                    f"Language: {button.get('data-language-label')}, "
-                    f"ID: {button.get('data-language-id')}")
-    
-    raise ProviderError(f"No matching download found for language '{language}' and provider '{provider}'")
\ No newline at end of file
+            logger.debug(f"Verfügbare Sprachen: {list(self.legacy_languages.keys())}")
+        logger.error(f"Kein passender Download für Sprache '{language}' und Provider "
+                     f"{', '.join(repr(provider) for provider in providers)} gefunden")
+        for provider_name, offers in self.buttons.items():
+            for language_label, (_, language_id) in offers.items():
+                logger.debug(f"Verfügbarer Button - Provider: {provider_name}, Language: {language_label}, ID: {language_id}")
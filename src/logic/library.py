@@ -0,0 +1,324 @@
+import os
+import re
+import sqlite3
+import subprocess
+import time
+from threading import Lock
+
+from src.constants import library_manifest, output_root
+from src.custom_logging import setup_logger
+
+logger = setup_logger(__name__)
+
+# ------------------------------------------------------- #
+#                   definitions
+# ------------------------------------------------------- #
+MANIFEST_FILE = ".library.sqlite3"
+MEDIA_EXTENSIONS = (".mp4", ".mkv")
+# file names written by EpisodeJob.file_name
+EPISODE_FILE_PATTERN = re.compile(r"^(?P<series>.+) - s(?P<season>\d+)e(?P<episode>\d+) - (?P<language>.+)\.\w+$")
+MOVIE_FILE_PATTERN = re.compile(r"^(?P<series>.+)-(?P<episode>\d+)\.\w+$")
+# seconds ffprobe may take to read the length of a finished download
+FFPROBE_TIMEOUT = 60
+# PRAGMA user_version of the current schema, 1: files.duration is the media length, not the download time
+SCHEMA_VERSION = 1
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS directories (
+    directory TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime_ns INTEGER
+);
+CREATE TABLE IF NOT EXISTS files (
+    directory TEXT NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER,
+    series TEXT,
+    season INTEGER,
+    episode INTEGER,
+    is_movie INTEGER,
+    language TEXT,
+    provider TEXT,
+    duration REAL,
+    completed REAL,
+    PRIMARY KEY (directory, name)
+);
+CREATE INDEX IF NOT EXISTS files_by_episode ON files (series, is_movie, season, episode);
+CREATE INDEX IF NOT EXISTS directories_by_parent ON directories (parent);
+"""
+
+# ------------------------------------------------------- #
+#                   global variables
+# ------------------------------------------------------- #
+# output root -> its manifest, a root can change between runs of one process
+manifests = {}
+manifest_lock = Lock()
+
+# ------------------------------------------------------- #
+#                      classes
+# ------------------------------------------------------- #
+
+
+class LibraryManifest:
+    """
+    SQLite manifest of every episode file below root, stored in root itself.
+
+    Downloads are recorded with series slug, season, episode, language,
+    provider, size, mtime, media duration (from ffprobe, when it is
+    installed) and completion time. Files that got there some other way are
+    picked up by reconciling: a directory is only listed again when its mtime
+    differs from the one stored at its last listing, otherwise its stored
+    rows are trusted as they are, so an unchanged library costs no listing
+    and no stat of its files. Skip checks
+    and "what's missing" questions are then queries on the indexed tables
+    instead of walks over the tree. Several processes can share one
+    manifest.
+    """
+
+    def __init__(self, root):
+        self.root = os.path.normpath(root)
+        self.file_name = os.path.join(self.root, MANIFEST_FILE)
+        self._lock = Lock()
+        os.makedirs(self.root, exist_ok=True)
+        self._connection = sqlite3.connect(self.file_name, timeout=30, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(SCHEMA)
+        # manifests written before files had an mtime
+        columns = [row[1] for row in self._connection.execute("PRAGMA table_info(files)")]
+        if "mtime_ns" not in columns:
+            with self._connection:
+                self._connection.execute("ALTER TABLE files ADD COLUMN mtime_ns INTEGER")
+        version, = self._connection.execute("PRAGMA user_version").fetchone()
+        if version < SCHEMA_VERSION:
+            with self._connection:
+                # earlier manifests stored how long the download took as duration
+                self._connection.execute("UPDATE files SET duration = NULL")
+                self._connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def key(self, dir_name):
+        """Directory relative to root with '/' separators, or None for directories outside of root."""
+        try:
+            relative = os.path.relpath(os.path.abspath(dir_name), os.path.abspath(self.root))
+        except ValueError:
+            # other drive on Windows
+            return None
+        if relative == os.pardir or relative.startswith(os.pardir + os.sep):
+            return None
+        return relative.replace(os.sep, "/")
+
+    def _scan(self, dir_name):
+        files, directories = {}, []
+        with os.scandir(dir_name) as iterator:
+            for entry in iterator:
+                try:
+                    if entry.is_dir():
+                        directories.append(entry.name)
+                    elif entry.name.endswith(MEDIA_EXTENSIONS) and not entry.name.endswith("_tmp.mp4"):
+                        stat = entry.stat()
+                        files[entry.name] = (stat.st_size, stat.st_mtime_ns)
+                except OSError:
+                    # entry may have been deleted while listing
+                    continue
+        return files, directories
+
+    def _forget(self, key):
+        """Drop a directory that is gone, with everything below it."""
+        pattern = key.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "/%"
+        self._connection.execute("DELETE FROM files WHERE directory = ? OR directory LIKE ? ESCAPE '\\'",
+                                 (key, pattern))
+        self._connection.execute("DELETE FROM directories WHERE directory = ? OR directory LIKE ? ESCAPE '\\'",
+                                 (key, pattern))
+
+    def _reconcile(self, dir_name, key):
+        """Bring the rows of one directory in line with the disk. Returns the keys of its subdirectories."""
+        row = self._connection.execute("SELECT mtime_ns FROM directories WHERE directory = ?", (key,)).fetchone()
+        try:
+            mtime_ns = os.stat(dir_name).st_mtime_ns
+        except FileNotFoundError:
+            with self._connection:
+                self._forget(key)
+            return []
+        except OSError as e:
+            logger.debug(f"Could not access directory {dir_name}: {e}")
+            return []
+        child_prefix = "" if key == "." else key + "/"
+        if row is not None and row[0] == mtime_ns:
+            # no file was added, removed or renamed, the stored rows are still right
+            return [child for child, in self._connection.execute(
+                "SELECT directory FROM directories WHERE parent = ?", (key,))]
+
+        # the mtime is taken before listing, a change during the listing is found next time
+        try:
+            files, directories = self._scan(dir_name)
+        except OSError as e:
+            logger.debug(f"Could not access directory {dir_name}: {e}")
+            return []
+        children = [child_prefix + directory for directory in directories]
+        with self._connection:
+            known = {name: (size, file_mtime_ns) for name, size, file_mtime_ns in self._connection.execute(
+                "SELECT name, size, mtime_ns FROM files WHERE directory = ?", (key,))}
+            for name in known.keys() - files.keys():
+                self._connection.execute("DELETE FROM files WHERE directory = ? AND name = ?", (key, name))
+            for name, (size, file_mtime_ns) in files.items():
+                if name not in known:
+                    self._insert(key, name, size, file_mtime_ns)
+                elif known[name] != (size, file_mtime_ns):
+                    self._update(key, name, size, file_mtime_ns)
+            for child, in self._connection.execute("SELECT directory FROM directories WHERE parent = ?",
+                                                   (key,)).fetchall():
+                if child not in children:
+                    self._forget(child)
+            self._connection.executemany("INSERT INTO directories (directory, parent) VALUES (?, ?) "
+                                         "ON CONFLICT (directory) DO UPDATE SET parent = excluded.parent",
+                                         [(child, key) for child in children])
+            self._connection.execute("INSERT INTO directories (directory, parent, mtime_ns) VALUES (?, ?, ?) "
+                                     "ON CONFLICT (directory) DO UPDATE SET mtime_ns = excluded.mtime_ns",
+                                     (key, parent_key(key), mtime_ns))
+        logger.debug(f"Reconciled {len(files)} file(s) in {dir_name} with the library manifest.")
+        return children
+
+    def _update(self, key, name, size, mtime_ns):
+        self._connection.execute("UPDATE files SET size = ?, mtime_ns = ? WHERE directory = ? AND name = ?",
+                                 (size, mtime_ns, key, name))
+
+    def _insert(self, key, name, size, mtime_ns, provider=None, duration=None, completed=None):
+        details = parse_file_name(name)
+        self._connection.execute(
+            "INSERT OR REPLACE INTO files (directory, name, size, mtime_ns, series, season, episode, is_movie, "
+            "language, provider, duration, completed) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (key, name, size, mtime_ns, details.get("series"), details.get("season"), details.get("episode"),
+             details.get("is_movie"), details.get("language"), provider, duration, completed))
+
+    def files(self, dir_name):
+        """{file name: size} of the media files in dir_name, reconciled with the disk first. None outside of root."""
+        key = self.key(dir_name)
+        if key is None:
+            return None
+        try:
+            with self._lock:
+                self._reconcile(dir_name, key)
+                return dict(self._connection.execute("SELECT name, size FROM files WHERE directory = ?", (key,)))
+        except sqlite3.Error as e:
+            logger.warning(f"Library manifest unavailable for {dir_name}: {e}")
+            return None
+
+    def reconcile_library(self):
+        """Reconcile every directory below root. Directories whose mtime did not change are not listed."""
+        started = time.monotonic()
+        pending, count = ["."], 0
+        with self._lock:
+            while pending:
+                key = pending.pop()
+                pending.extend(self._reconcile(os.path.join(self.root, *key.split("/")), key))
+                count += 1
+        logger.debug(f"Reconciled {count} directories in {time.monotonic() - started:.2f}s.")
+
+    def record(self, file_name, provider=None):
+        """
+        Record a finished download. Series, season, episode and language are
+        read from the file name, the duration from the file itself.
+        """
+        dir_name, name = os.path.split(os.path.normpath(file_name))
+        key = self.key(dir_name)
+        if key is None:
+            return
+        try:
+            stat = os.stat(file_name)
+        except OSError:
+            return
+        duration = media_duration(file_name)
+        try:
+            with self._lock, self._connection:
+                self._insert(key, name, stat.st_size, stat.st_mtime_ns, provider, duration, time.time())
+        except sqlite3.Error as e:
+            logger.warning(f"Could not record {file_name} in the library manifest: {e}")
+
+    def episodes(self, series, season=None, language=None):
+        """{(season, episode)} of series with a non-empty file. Movies are in season 0."""
+        query = "SELECT DISTINCT season, episode, is_movie FROM files WHERE series = ? AND size > 0"
+        parameters = [series]
+        if season is not None:
+            query += " AND season = ?"
+            parameters.append(season)
+        if language is not None:
+            # movie file names carry no language
+            query += " AND (language = ? OR is_movie = 1)"
+            parameters.append(language)
+        with self._lock:
+            rows = self._connection.execute(query, parameters).fetchall()
+        return {(0 if is_movie else season, episode) for season, episode, is_movie in rows}
+
+    def missing_episodes(self, series, season, episode_count, language=None):
+        """Episode numbers 1..episode_count of season (0 = movies) without a file."""
+        present = self.episodes(series, season if season else None, language)
+        return [episode for episode in range(1, episode_count + 1) if (season, episode) not in present]
+
+# ------------------------------------------------------- #
+#                      functions
+# ------------------------------------------------------- #
+
+
+def parse_file_name(name):
+    """Series slug, season, episode, language and is_movie of a file name written by the downloader, or {}."""
+    match = EPISODE_FILE_PATTERN.match(name)
+    if match:
+        return {"series": match.group("series"), "season": int(match.group("season")),
+                "episode": int(match.group("episode")), "language": match.group("language"), "is_movie": 0}
+    match = MOVIE_FILE_PATTERN.match(name)
+    if match:
+        return {"series": match.group("series"), "season": None, "episode": int(match.group("episode")),
+                "language": None, "is_movie": 1}
+    return {}
+
+
+def ffprobe_path():
+    """ffprobe next to the bundled ffmpeg.exe if there is one, else the one on PATH."""
+    if os.path.exists("ffprobe.exe"):
+        return "ffprobe.exe"
+    if os.path.exists("src/ffprobe.exe"):
+        return "src/ffprobe.exe"
+    return "ffprobe"
+
+
+def media_duration(file_name):
+    """Length of the media file in seconds, or None if ffprobe is missing or can't read it."""
+    try:
+        result = subprocess.run([ffprobe_path(), "-v", "error", "-show_entries", "format=duration",
+                                 "-of", "default=noprint_wrappers=1:nokey=1", file_name],
+                                capture_output=True, text=True, timeout=FFPROBE_TIMEOUT)
+        return float(result.stdout.strip())
+    except (OSError, subprocess.SubprocessError, ValueError) as e:
+        logger.debug(f"Could not read the duration of {file_name}: {e}")
+        return None
+
+
+def parent_key(key):
+    if key == ".":
+        return None
+    return key.rsplit("/", 1)[0] if "/" in key else "."
+
+
+def get_manifest(root=None):
+    """The manifest of root (default: output_root), or None if library_manifest is 0 or it can't be opened."""
+    root = root or output_root
+    if not library_manifest or not root:
+        return None
+    root = os.path.normpath(root)
+    with manifest_lock:
+        if root not in manifests:
+            try:
+                manifests[root] = LibraryManifest(root)
+            except (OSError, sqlite3.Error) as e:
+                logger.warning(f"Could not open the library manifest in {root}: {e}")
+                return None
+        return manifests[root]
+
+
+def manifest_for(dir_name):
+    """The opened manifest with the innermost root that contains dir_name, or None."""
+    with manifest_lock:
+        candidates = sorted(manifests.values(), key=lambda candidate: len(candidate.root), reverse=True)
+    for candidate in candidates:
+        if candidate.key(dir_name) is not None:
+            return candidate
+    return None
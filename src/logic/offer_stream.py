@@ -0,0 +1,111 @@
+import codecs
+from html.parser import HTMLParser
+
+from src.constants import stream_offer_pages
+from src.custom_logging import setup_logger
+from src.logic import page_cache, parse_pool, transport
+from src.logic.language import OfferTable
+
+logger = setup_logger(__name__)
+
+# ------------------------------------------------------- #
+#                   definitions
+# ------------------------------------------------------- #
+# element around every provider button of an episode page
+OFFER_CONTAINER_ID = "episode-links"
+VOID_ELEMENTS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param", "source",
+                 "track", "wbr"}
+STREAM_CHUNK_SIZE = 8 * 1024
+
+# ------------------------------------------------------- #
+#                      classes
+# ------------------------------------------------------- #
+
+
+class OfferScanner(HTMLParser):
+    """
+    Incremental parser for episode pages fed chunk by chunk. Collects the
+    provider buttons and reports done once the element holding them is
+    closed, i.e. once every offer of the page has been seen. Pages of the
+    old structure (li[data-lang-key] entries) are flagged as legacy.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.buttons = {}
+        self.legacy = False
+        self.done = False
+        self._open_tags = []
+        self._container_depth = None
+
+    def handle_starttag(self, tag, attrs):
+        attributes = dict(attrs)
+        if tag == "button" and "data-provider-name" in attributes and "data-language-label" in attributes:
+            self.buttons.setdefault((attributes["data-provider-name"] or "").upper(), {}).setdefault(
+                attributes["data-language-label"] or "",
+                (attributes.get("data-play-url") or "", attributes.get("data-language-id") or ""))
+        elif tag == "li" and "data-lang-key" in attributes:
+            self.legacy = True
+        if tag in VOID_ELEMENTS:
+            return
+        self._open_tags.append(tag)
+        if attributes.get("id") == OFFER_CONTAINER_ID and self._container_depth is None:
+            self._container_depth = len(self._open_tags)
+
+    def handle_startendtag(self, tag, attrs):
+        # <tag/> opens no element
+        depth = len(self._open_tags)
+        self.handle_starttag(tag, attrs)
+        del self._open_tags[depth:]
+
+    def handle_endtag(self, tag):
+        if tag not in self._open_tags:
+            return
+        while self._open_tags:
+            if self._open_tags.pop() == tag:
+                break
+        if self._container_depth is not None and len(self._open_tags) < self._container_depth:
+            self.done = bool(self.buttons)
+
+
+# ------------------------------------------------------- #
+#                      functions
+# ------------------------------------------------------- #
+
+
+def fetch_offers(internal_link) -> OfferTable:
+    """
+    OfferTable of an episode page. Pages are parsed while they arrive and
+    the download stops once the provider buttons are complete, leaving
+    comments, recommendations and footer unread. What was read up to there
+    is what the page cache keeps (page_cache_ttl_episode) together with the
+    page's ETag, so a cached or revalidated page still holds every offer.
+    Pages of unknown or old structure are read completely.
+    """
+    meta, body, fresh = page_cache.fresh_entry(internal_link)
+    if fresh:
+        return parse_pool.parse(OfferTable.from_html, body)
+    if not stream_offer_pages:
+        return parse_pool.parse(OfferTable.from_html, page_cache.get_page(internal_link))
+
+    scanner = OfferScanner()
+    chunks = []
+    with transport.fetch(internal_link, stream=True, headers=page_cache.revalidation_headers(meta)) as response:
+        if response.status_code != 304:
+            # requests assumes ISO-8859-1 for text/html without a charset, the site sends utf-8
+            charset_given = "charset" in response.headers.get("Content-Type", "").lower()
+            decoder = codecs.getincrementaldecoder(response.encoding if charset_given else "utf-8")(errors="replace")
+            for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+                chunks.append(chunk)
+                if not scanner.legacy:
+                    scanner.feed(decoder.decode(chunk))
+                if scanner.done:
+                    break
+    if scanner.done:
+        page_cache.stats.count("partial")
+        logger.debug(f"Read {sum(map(len, chunks))} bytes of {internal_link} to find its offers.")
+        # episode pages are only ever read for their offers, the part read holds all of them
+        page_cache.store_response(internal_link, meta, response, b"".join(chunks))
+        return OfferTable(scanner.buttons, {}, {})
+    html = page_cache.store_response(internal_link, meta, response, b"".join(chunks))
+    return parse_pool.parse(OfferTable.from_html, html)
@@ -0,0 +1,155 @@
+import hashlib
+import json
+import os
+import re
+import time
+from threading import Lock, get_ident
+
+from src.constants import page_cache_ttl_episode, page_cache_ttl_season, page_cache_ttl_series
+from src.custom_logging import setup_logger
+from src.logic import transport
+
+logger = setup_logger(__name__)
+
+# ------------------------------------------------------- #
+#                   definitions
+# ------------------------------------------------------- #
+CACHE_DIR = "cache/pages"
+URL_CLASSES = [
+    ("episode", re.compile(r"/(staffel-\d+/episode-\d+|filme/film-\d+)/?$"), page_cache_ttl_episode),
+    ("season", re.compile(r"/(staffel-\d+|filme)/?$"), page_cache_ttl_season),
+    ("series", re.compile(r"/(anime|serie)/(stream/)?[^/]+/?$"), page_cache_ttl_series),
+]
+
+# ------------------------------------------------------- #
+#                      classes
+# ------------------------------------------------------- #
+
+
+class PageCacheStats:
+    def __init__(self):
+        self._lock = Lock()
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        # pages only read up to what the caller needed
+        self.partial = 0
+
+    def count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+
+stats = PageCacheStats()
+
+# ------------------------------------------------------- #
+#                      functions
+# ------------------------------------------------------- #
+
+
+def ttl_for(url):
+    """Return (url class, ttl in seconds) or (None, 0) for urls that are not cached."""
+    for url_class, pattern, ttl in URL_CLASSES:
+        if pattern.search(url):
+            return url_class, ttl
+    return None, 0
+
+
+def entry_paths(url):
+    key = hashlib.sha1(url.encode("utf-8")).hexdigest()
+    return os.path.join(CACHE_DIR, key + ".json"), os.path.join(CACHE_DIR, key + ".html")
+
+
+def read_entry(url):
+    meta_path, body_path = entry_paths(url)
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        with open(body_path, "rb") as f:
+            body = f.read()
+    except (OSError, ValueError):
+        return None, None
+    return meta, body
+
+
+def write_atomic(file_path, data):
+    tmp_path = f"{file_path}.{os.getpid()}.{get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, file_path)
+
+
+def write_entry(url, meta, body=None):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    meta_path, body_path = entry_paths(url)
+    if body is not None:
+        write_atomic(body_path, body)
+    write_atomic(meta_path, json.dumps(meta).encode("utf-8"))
+
+
+def fresh_entry(url):
+    """
+    Return (meta, body, fresh) of the cached entry of url. fresh says whether
+    body may be used without asking the site; meta is None if nothing is cached.
+    """
+    url_class, ttl = ttl_for(url)
+    if not ttl:
+        return None, None, False
+    meta, body = read_entry(url)
+    if meta is not None and time.time() - meta["stored_at"] < ttl:
+        logger.debug(f"Page cache hit ({url_class}): {url}")
+        stats.count("hits")
+        return meta, body, True
+    return meta, body, False
+
+
+def revalidation_headers(meta):
+    headers = {}
+    if meta is not None:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+    return headers
+
+
+def store_response(url, meta, response, body):
+    """
+    Record the answer to a (conditional) request for url and return the page:
+    the cached body for 304, else body, which is stored if url is cacheable.
+    """
+    url_class, ttl = ttl_for(url)
+    if response.status_code == 304 and meta is not None:
+        logger.debug(f"Page cache revalidated ({url_class}): {url}")
+        stats.count("revalidated")
+        meta["stored_at"] = time.time()
+        write_entry(url, meta)
+        return read_entry(url)[1]
+
+    if ttl:
+        stats.count("misses")
+        write_entry(url, {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "stored_at": time.time(),
+        }, body)
+    return body
+
+
+def get_page(url) -> bytes:
+    """
+    Return the body of url, served from the on-disk cache while it is younger
+    than the TTL of its url class and revalidated with ETag/Last-Modified once
+    it is older. Urls outside the known classes are always fetched.
+    """
+    meta, body, fresh = fresh_entry(url)
+    if fresh:
+        return body
+    response = transport.fetch(url, headers=revalidation_headers(meta))
+    return store_response(url, meta, response, response.content)
+
+
+def format_stats():
+    return "Page cache: {} hits, {} revalidated (304), {} misses, {} read partially.".format(
+        stats.hits, stats.revalidated, stats.misses, stats.partial)
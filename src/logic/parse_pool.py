@@ -0,0 +1,76 @@
+import atexit
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from threading import Lock
+
+from src.constants import parse_processes
+from src.custom_logging import setup_logger
+
+logger = setup_logger(__name__)
+
+# ------------------------------------------------------- #
+#                   definitions
+# ------------------------------------------------------- #
+# seconds a page may take in a parse process before it is parsed in the calling thread instead
+PARSE_TIMEOUT = 60
+
+# ------------------------------------------------------- #
+#                   global variables
+# ------------------------------------------------------- #
+parse_executor = None
+executor_lock = Lock()
+
+# ------------------------------------------------------- #
+#                      functions
+# ------------------------------------------------------- #
+
+
+def get_parse_executor():
+    """
+    Process pool for HTML parsing when parse_processes is set, else None.
+
+    Workers receive the raw page and return small extracted structures
+    (offer tables, episode lists, stream urls), so parsing many pages scales
+    across cores instead of queueing behind the GIL. The functions handed to
+    the pool must be module level so they can be pickled.
+
+    The processes are started with forkserver (spawn where that is missing):
+    the pool is created lazily from the resolve thread while download
+    threads run, and a forked child can inherit a lock one of them held and
+    hang on it.
+    """
+    global parse_executor
+    if parse_processes <= 0:
+        return None
+    with executor_lock:
+        if parse_executor is None:
+            logger.debug(f"Starting {parse_processes} parse process(es).")
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            parse_executor = ProcessPoolExecutor(max_workers=parse_processes,
+                                                 mp_context=multiprocessing.get_context(method))
+            atexit.register(parse_executor.shutdown, cancel_futures=True)
+        return parse_executor
+
+
+def drop_parse_executor(executor):
+    """Shut down executor without waiting for it, so the next parse starts a fresh pool."""
+    global parse_executor
+    with executor_lock:
+        if parse_executor is executor:
+            parse_executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def parse(func, *args):
+    """Run func(*args) in the parse pool if there is one, else in the calling thread."""
+    executor = get_parse_executor()
+    if executor is None:
+        return func(*args)
+    try:
+        return executor.submit(func, *args).result(timeout=PARSE_TIMEOUT)
+    except (FutureTimeout, BrokenProcessPool) as e:
+        logger.warning(f"Parse process failed ({type(e).__name__}), parsing {func.__name__} in this thread.")
+        drop_parse_executor(executor)
+    return func(*args)
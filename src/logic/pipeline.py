@@ -0,0 +1,254 @@
+import asyncio
+import queue
+from collections import Counter
+from threading import Condition, Event, Thread
+
+from src import constants
+from src.constants import (cliProvider, dlMode, language, name, normalize_name_for_folder, season_override,
+                           site_url, type_of_media)
+from src.custom_logging import setup_logger
+from src.logic.async_resolver import AsyncResolver
+from src.r_w_file_handler import read_config_variable
+
+logger = setup_logger(__name__)
+
+# ------------------------------------------------------- #
+#                   definitions
+# ------------------------------------------------------- #
+STOP = None
+# seconds the resolve stage waits for a job before it checks whether it was closed
+POLL_INTERVAL = 0.5
+
+# ------------------------------------------------------- #
+#                      classes
+# ------------------------------------------------------- #
+
+
+class RunSettings:
+    """
+    Tunables of a run that the settings page can change while the process
+    runs. Runs take them from here instead of the values src.constants read
+    at import, and the download pool and rate limiter are adjusted to them
+    when a run starts.
+    """
+
+    def __init__(self, output_root, max_download_threads=1, download_queue_size=None, download_limits=None,
+                 rate_limit_initial=2, rate_limit_max=10):
+        self.output_root = output_root
+        self.max_download_threads = max_download_threads or 1
+        self.download_queue_size = download_queue_size or self.max_download_threads
+        self.download_limits = dict(download_limits or {})
+        self.rate_limit_initial = rate_limit_initial
+        self.rate_limit_max = rate_limit_max
+
+    @classmethod
+    def from_constants(cls):
+        """The settings read when the process started."""
+        return cls(constants.output_root, constants.max_download_threads, constants.download_queue_size,
+                   constants.download_limits, constants.rate_limit_initial, constants.rate_limit_max)
+
+    @classmethod
+    def read(cls):
+        """The settings as they are in the config file now."""
+        max_download_threads = read_config_variable("max_download_threads", 1)
+        return cls(read_config_variable("output_root", constants.output_root), max_download_threads,
+                   read_config_variable("download_queue_size", max_download_threads),
+                   {"VOE": read_config_variable("download_limit_voe", 0),
+                    "Vidoza": read_config_variable("download_limit_vidoza", 0),
+                    "Streamtape": read_config_variable("download_limit_streamtape", 0)},
+                   read_config_variable("rate_limit_initial", 2), read_config_variable("rate_limit_max", 10))
+
+
+class SeriesSpec:
+    """
+    What to download of one show: the values py_main.py takes from the command
+    line, and the RunSettings to download it with (default: the ones read at
+    import).
+    """
+
+    def __init__(self, type_of_media, name, language="Deutsch", dl_mode="Series", season_override=0, provider="VOE",
+                 settings=None):
+        self.type_of_media = type_of_media
+        self.name = name
+        self.language = language
+        self.dl_mode = dl_mode
+        self.season_override = season_override
+        self.provider = provider
+        self.settings = settings or RunSettings.from_constants()
+
+    @classmethod
+    def from_constants(cls):
+        return cls(type_of_media, name, language, dlMode, season_override, cliProvider)
+
+    @property
+    def site_url(self):
+        return site_url[self.type_of_media]
+
+    @property
+    def url(self):
+        return "{}/{}/stream/{}/".format(self.site_url, self.type_of_media, self.name)
+
+    @property
+    def output_name(self):
+        return normalize_name_for_folder(self.name)
+
+    def __str__(self):
+        return f"{self.type_of_media}/{self.name} ({self.language}, {self.dl_mode}, season {self.season_override})"
+
+
+class Progress:
+    """
+    What happens to the episodes of one show, as events. listener(event, data)
+    is called for each of them, from the thread the event happened in:
+
+    series       the show was looked up: title, year, seasons, output_path
+    skipped      the episode is on disk already
+    unavailable  no provider offers the episode
+    queued       the episode waits for a download worker: provider
+    downloading  a worker started the download: provider, file_name
+    done         the download finished
+    failed       the download or the stream lookup gave up, or the run was cancelled
+
+    Events about an episode carry it as data["episode"]. wait() returns once
+    every queued episode is done or failed, cancel() keeps further episodes
+    from being listed or started.
+    """
+
+    def __init__(self, listener=None):
+        self.listener = listener
+        self.counts = Counter()
+        self.cancelled = False
+        self._changed = Condition()
+
+    def emit(self, event, **data):
+        with self._changed:
+            self.counts[event] += 1
+            self._changed.notify_all()
+        if self.listener:
+            try:
+                self.listener(event, data)
+            except Exception as e:
+                logger.warning(f"Progress listener failed on {event}: {e}")
+
+    @property
+    def pending(self):
+        """Queued episodes that are not done or failed yet."""
+        return self.counts["queued"] - self.counts["done"] - self.counts["failed"]
+
+    def wait(self):
+        with self._changed:
+            self._changed.wait_for(lambda: self.pending <= 0)
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class EpisodeJob:
+    """One episode or movie of series to fetch: where it is on the site and where it goes on disk."""
+
+    def __init__(self, series, season, episode, link, directory, is_movie=False, progress=None):
+        self.series = series
+        self.name = series.name
+        self.season = season
+        self.episode = episode
+        self.link = link
+        self.directory = directory
+        self.is_movie = is_movie
+        self.progress = progress
+
+    @property
+    def cancelled(self):
+        return self.progress is not None and self.progress.cancelled
+
+    def emit(self, event, **data):
+        """Report event about this episode to the progress of its run, if it has one."""
+        if self.progress:
+            self.progress.emit(event, episode=str(self), **data)
+
+    def file_name(self, lang, extension="mp4"):
+        if self.is_movie:
+            return "{}/{}-{}.{}".format(self.directory, self.name, self.episode, extension)
+        return "{}/{} - s{:02}e{:02} - {}.{}".format(self.directory, self.name, self.season, self.episode, lang,
+                                                     extension)
+
+    def __str__(self):
+        if self.is_movie:
+            return f"{self.name} Movie {self.episode}"
+        return f"{self.name} S{self.season:02}E{self.episode:02}"
+
+
+class ResolveStage:
+    """
+    Middle stage of the download pipeline: an asyncio event loop in a worker
+    thread takes episode jobs from a bounded queue and resolves up to
+    concurrency of them at once with resolve(resolver, job). Each result is
+    handed to handle(job, result), in job order, which queues the download;
+    None results are skipped. put() blocks while the queue is full, so the
+    job generator never runs far ahead of resolution, and resolution never
+    runs far ahead of the download pool (whose submit() blocks the same way).
+    """
+
+    def __init__(self, resolve, handle, concurrency, queue_size):
+        self.resolve = resolve
+        self.handle = handle
+        self.concurrency = max(1, int(concurrency))
+        self._jobs = queue.Queue(maxsize=max(1, int(queue_size)))
+        self._closed = Event()
+        self._thread = Thread(target=lambda: asyncio.run(self._run()), name="resolve", daemon=True)
+        self._thread.start()
+
+    def put(self, job):
+        while True:
+            if not self._thread.is_alive():
+                raise RuntimeError("The resolve stage is not running.")
+            try:
+                self._jobs.put(job, timeout=POLL_INTERVAL)
+                return
+            except queue.Full:
+                continue
+
+    def close(self):
+        """Let the stage finish the queued jobs and wait for it. Safe to call more than once."""
+        self._closed.set()
+        self._thread.join()
+
+    def _next_job(self):
+        # never blocks for longer than POLL_INTERVAL, so no executor thread outlives a closed stage
+        try:
+            return self._jobs.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            return STOP
+
+    async def _run(self):
+        resolver = AsyncResolver()
+        slots = asyncio.Semaphore(self.concurrency)
+        previous = None
+        while True:
+            job = await asyncio.to_thread(self._next_job)
+            if job is STOP:
+                if self._closed.is_set() and self._jobs.empty():
+                    break
+                continue
+            await slots.acquire()
+            previous = asyncio.create_task(self._process(resolver, job, slots, previous))
+        if previous:
+            await previous
+
+    async def _process(self, resolver, job, slots, previous):
+        # the slot is held until the hand-over, so a full download queue also pauses resolution
+        try:
+            try:
+                result = await self.resolve(resolver, job)
+            except Exception as e:
+                logger.error(f"Could not resolve {job}: {e}")
+                result = None
+            # hand over in job order
+            if previous:
+                await previous
+            if result is not None:
+                try:
+                    await asyncio.to_thread(self.handle, job, result)
+                except Exception as e:
+                    logger.error(f"Could not queue {job}: {e}")
+        finally:
+            slots.release()
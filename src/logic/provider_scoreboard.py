@@ -0,0 +1,120 @@
+import json
+import os
+import tempfile
+import time
+from threading import Lock
+
+from src.constants import provider_priority, provider_score_half_life
+from src.custom_logging import setup_logger
+
+logger = setup_logger(__name__)
+
+# ------------------------------------------------------- #
+#                   definitions
+# ------------------------------------------------------- #
+SCOREBOARD_FILE = "cache/provider_scores.json"
+# weight of a new measurement in the moving averages
+SMOOTHING = 0.3
+# what we assume about a provider without (recent) history: it works at typical speed
+PRIOR = {"success": 1.0, "resolve_latency": 3.0, "ttfb": 1.0, "throughput": None}
+# seconds of resolve latency / time to first byte that halve a provider's score
+LATENCY_SCALE = 10.0
+# bonus for the provider requested on the command line
+PREFERRED_BONUS = 1.1
+
+# ------------------------------------------------------- #
+#                      classes
+# ------------------------------------------------------- #
+
+
+class ProviderScoreboard:
+    """
+    Persistent per-provider history of resolve success rate, resolve latency,
+    time to first byte and download throughput.
+
+    Every value is a moving average that decays back to PRIOR with the
+    configured half-life, so a provider that had a bad week is tried again
+    once the bad measurements are old enough.
+    """
+
+    def __init__(self, file_name, half_life_hours):
+        self.file_name = file_name
+        self.half_life = max(half_life_hours, 1) * 3600
+        self._lock = Lock()
+        self.providers = self._load()
+
+    def _load(self):
+        try:
+            with open(self.file_name, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self):
+        dir_name = os.path.dirname(self.file_name)
+        os.makedirs(dir_name, exist_ok=True)
+        # a temporary file of its own, several processes may save at the same time
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=dir_name, suffix=".tmp", delete=False) as f:
+            json.dump(self.providers, f, indent=2)
+        try:
+            os.replace(f.name, self.file_name)
+        except OSError:
+            os.remove(f.name)
+            raise
+
+    def _decayed(self, provider, field):
+        entry = self.providers.get(provider, {})
+        value = entry.get(field)
+        prior = PRIOR[field]
+        if value is None or prior is None:
+            return value
+        age = time.time() - entry.get("updated_" + field, 0)
+        weight = 0.5 ** (age / self.half_life)
+        return prior + (value - prior) * weight
+
+    def _update(self, provider, field, measurement):
+        entry = self.providers.setdefault(provider, {})
+        current = self._decayed(provider, field)
+        if current is None:
+            current = measurement
+        entry[field] = current + (measurement - current) * SMOOTHING
+        entry["updated_" + field] = time.time()
+
+    def record_resolve(self, provider, success, latency):
+        with self._lock:
+            self._update(provider, "success", 1.0 if success else 0.0)
+            if success:
+                self._update(provider, "resolve_latency", latency)
+            self._save()
+
+    def record_download(self, provider, ttfb, size, duration):
+        if not size or duration <= 0:
+            return
+        with self._lock:
+            if ttfb is not None:
+                self._update(provider, "ttfb", ttfb)
+            self._update(provider, "throughput", size / duration)
+            self._save()
+
+    def score(self, provider, best_throughput):
+        success, resolve_latency, ttfb = (self._decayed(provider, field) for field in ("success", "resolve_latency", "ttfb"))
+        success = PRIOR["success"] if success is None else success
+        latency = (PRIOR["resolve_latency"] if resolve_latency is None else resolve_latency) + \
+                  (PRIOR["ttfb"] if ttfb is None else ttfb)
+        throughput = self._decayed(provider, "throughput")
+        speed = 1.0 if not throughput or not best_throughput else 0.5 + 0.5 * throughput / best_throughput
+        return success * speed / (1 + latency / LATENCY_SCALE)
+
+    def ordered_providers(self, preferred):
+        """provider_priority ordered by score, the preferred provider first among equals."""
+        with self._lock:
+            throughputs = [self._decayed(provider, "throughput") or 0 for provider in provider_priority]
+            best_throughput = max(throughputs)
+            scores = {provider: self.score(provider, best_throughput) * (PREFERRED_BONUS if provider == preferred else 1)
+                      for provider in provider_priority}
+        ordered = sorted(provider_priority, key=lambda provider: (-scores[provider], provider != preferred))
+        logger.debug("Provider order: " + ", ".join(f"{provider} ({scores[provider]:.2f})" for provider in ordered))
+        return ordered
+
+
+scoreboard = ProviderScoreboard(SCOREBOARD_FILE, provider_score_half_life)
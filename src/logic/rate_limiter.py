@@ -0,0 +1,183 @@
+import re
+import time
+from email.utils import parsedate_to_datetime
+from threading import Lock
+
+from src.constants import rate_limit_initial, rate_limit_max, retry_max_delay
+from src.custom_logging import setup_logger
+
+logger = setup_logger(__name__)
+
+# ------------------------------------------------------- #
+#                   definitions
+# ------------------------------------------------------- #
+# requests per second a host is never slowed down below
+MIN_RATE = 0.05
+# requests per second added after every healthy answer...
+ADDITIVE_STEP = 0.1
+# ...and the factor applied when the host pushes back
+DECREASE_FACTOR = 0.5
+# a burst of throttled answers to requests already in flight counts as one signal
+DECREASE_WINDOW = 2.0
+THROTTLE_STATUS_CODES = {429, 503}
+# widgets and scripts of captcha services; normal site pages embed them too (s.to has a turnstile on every page)
+CAPTCHA_PATTERN = re.compile(rb"g-recaptcha|h-captcha|hcaptcha\.com|cf-challenge|challenge-platform|turnstile",
+                             re.IGNORECASE)
+# only found on the interstitial pages a bot check puts in front of the site
+CHALLENGE_PAGE_PATTERN = re.compile(rb"cf-chl-|id=\"challenge-form\"|<title>\s*(?:just a moment|attention required|"
+                                    rb"ddos-guard)", re.IGNORECASE)
+# what every series, season and episode page of the sites links or offers
+SITE_CONTENT_PATTERN = re.compile(rb"episode-links|data-provider-name|data-lang-key|/staffel-\d+|/filme")
+CHALLENGE_STATUS_CODES = {403}
+
+# ------------------------------------------------------- #
+#                      classes
+# ------------------------------------------------------- #
+
+
+class HostBucket:
+    """
+    Token bucket of one host whose rate adapts AIMD style: every healthy answer
+    raises it by ADDITIVE_STEP up to rate_limit_max, a 429/503 or captcha page
+    multiplies it by DECREASE_FACTOR. A Retry-After header blocks the host
+    completely for that long.
+    """
+
+    def __init__(self, host, rate, max_rate):
+        self.host = host
+        self.rate = rate
+        self.max_rate = max_rate
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.last_decrease = 0.0
+        self.decreases = 0
+        self.waited = 0.0
+        self._lock = Lock()
+
+    def _refill(self, now):
+        burst = max(1.0, self.rate)
+        self.tokens = min(burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """Block until the host may receive the next request."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                delay = self.blocked_until - now
+                if delay <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    delay = (1 - self.tokens) / self.rate
+                self.waited += delay
+            time.sleep(delay)
+
+    def healthy(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + ADDITIVE_STEP)
+
+    def throttled(self, reason, retry_after=None):
+        with self._lock:
+            now = time.monotonic()
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, now + min(retry_after, retry_max_delay))
+            if now - self.last_decrease < DECREASE_WINDOW:
+                return
+            self.last_decrease = now
+            self.decreases += 1
+            self.rate = max(MIN_RATE, self.rate * DECREASE_FACTOR)
+            self.tokens = 0.0
+        logger.info(f"{self.host} answered with {reason}. Slowing down to {self.rate:.2f} requests/s.")
+
+
+class RateLimiter:
+    def __init__(self, initial_rate, max_rate):
+        self.initial_rate = max(initial_rate, MIN_RATE)
+        self.max_rate = max(max_rate, self.initial_rate)
+        self.buckets = {}
+        self._lock = Lock()
+
+    def configure(self, initial_rate, max_rate):
+        """
+        Change the limits of a running limiter. Hosts seen so far start over
+        from the new initial rate, throttled ones keep their lower rate and
+        any Retry-After block.
+        """
+        initial_rate = max(initial_rate, MIN_RATE)
+        max_rate = max(max_rate, initial_rate)
+        with self._lock:
+            if (initial_rate, max_rate) == (self.initial_rate, self.max_rate):
+                return
+            self.initial_rate, self.max_rate = initial_rate, max_rate
+            buckets = list(self.buckets.values())
+        for bucket in buckets:
+            with bucket._lock:
+                bucket.max_rate = max_rate
+                bucket.rate = min(bucket.rate, initial_rate) if bucket.decreases else initial_rate
+        logger.debug(f"Rate limits set to {initial_rate}/s at the start and {max_rate}/s at most.")
+
+    def bucket(self, host):
+        with self._lock:
+            if host not in self.buckets:
+                self.buckets[host] = HostBucket(host, self.initial_rate, self.max_rate)
+            return self.buckets[host]
+
+    def acquire(self, host):
+        self.bucket(host).acquire()
+
+    def feedback(self, host, response, body_loaded):
+        """Adapt the rate of host to response. Captcha pages are only detected in bodies already read."""
+        bucket = self.bucket(host)
+        if response.status_code in THROTTLE_STATUS_CODES:
+            bucket.throttled(f"HTTP {response.status_code}", parse_retry_after(response.headers.get("Retry-After")))
+        elif body_loaded and is_challenge_page(response):
+            bucket.throttled("a captcha page")
+        elif response.status_code < 400:
+            bucket.healthy()
+
+
+limiter = RateLimiter(rate_limit_initial, rate_limit_max)
+
+# ------------------------------------------------------- #
+#                      functions
+# ------------------------------------------------------- #
+
+
+def is_challenge_page(response):
+    """
+    True for a bot check instead of the requested page: an interstitial page,
+    or a captcha that comes with a 403 or replaces the content of the page.
+    A captcha widget on a normal page is not one.
+    """
+    if "html" not in response.headers.get("Content-Type", ""):
+        return False
+    body = response.content
+    if CHALLENGE_PAGE_PATTERN.search(body):
+        return True
+    if not CAPTCHA_PATTERN.search(body):
+        return False
+    return response.status_code in CHALLENGE_STATUS_CODES or not SITE_CONTENT_PATTERN.search(body)
+
+
+def parse_retry_after(value):
+    """Seconds from a Retry-After header given as seconds or HTTP date, None if absent or unreadable."""
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return int(value)
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def format_stats():
+    throttled = [bucket for bucket in limiter.buckets.values() if bucket.decreases or bucket.waited >= 1]
+    if not throttled:
+        return "Rate limits: no host had to be slowed down."
+    return "Rate limits: " + ", ".join(
+        f"{bucket.host} {bucket.rate:.2f}/s ({bucket.decreases} backoffs, waited {bucket.waited:.0f}s)"
+        for bucket in sorted(throttled, key=lambda bucket: bucket.host))
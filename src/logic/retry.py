@@ -0,0 +1,173 @@
+import random
+import time
+from threading import Lock
+
+import requests
+
+from src.constants import (circuit_breaker_cooldown, circuit_breaker_threshold, retry_attempts, retry_base_delay,
+                           retry_max_delay)
+from src.custom_logging import setup_logger
+
+logger = setup_logger(__name__)
+
+# ------------------------------------------------------- #
+#                   definitions
+# ------------------------------------------------------- #
+# answers worth asking again for: rate limited or the server had a problem
+RETRYABLE_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504, 520, 521, 522, 523, 524}
+
+# ------------------------------------------------------- #
+#                      classes
+# ------------------------------------------------------- #
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """Raised instead of sending a request to a host whose circuit breaker is open."""
+
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+class RetryStats:
+    def __init__(self):
+        self._lock = Lock()
+        self.retries = {}
+        self.gave_up = 0
+        self.rejected = 0
+
+    def retried(self, name):
+        with self._lock:
+            self.retries[name] = self.retries.get(name, 0) + 1
+
+    def count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+
+stats = RetryStats()
+
+
+class RetryPolicy:
+    """
+    Retry with capped exponential backoff and jitter.
+
+    The n-th retry waits a random time between half and all of
+    min(max_delay, base_delay * 2 ** (n - 1)) seconds, so many workers that
+    failed at the same moment do not come back at the same moment.
+    """
+
+    def __init__(self, name, attempts, base_delay, max_delay):
+        self.name = name
+        self.attempts = max(attempts, 1)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def backoff(self, attempt):
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return random.uniform(delay / 2, delay)
+
+    def wait(self, attempt, reason):
+        """Count a retry after the failed attempt number attempt and sleep its backoff."""
+        delay = self.backoff(attempt)
+        stats.retried(self.name)
+        logger.info(f"{reason} Retrying in {delay:.1f}s (attempt {attempt + 1}/{self.attempts}).")
+        time.sleep(delay)
+
+    def give_up(self):
+        stats.count("gave_up")
+
+    def call(self, func, *args, retry_if=None, **kwargs):
+        """Call func until it returns, raises an error retry_if rejects or runs out of attempts."""
+        retry_if = retry_if or is_retryable
+        for attempt in range(1, self.attempts + 1):
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if not retry_if(e):
+                    raise
+                if attempt == self.attempts:
+                    self.give_up()
+                    raise
+                self.wait(attempt, f"{self.name}: {e}.")
+
+
+class CircuitBreaker:
+    """
+    Per-host failure counter. After threshold consecutive failures the host is
+    considered down and requests to it fail immediately for cooldown seconds.
+    Then a single probe request is let through; its outcome closes the circuit
+    again or starts another cooldown.
+    """
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._lock = Lock()
+        self.failures = {}
+        self.opened_at = {}
+        self.probing = set()
+
+    def before_request(self, host):
+        if self.threshold <= 0:
+            return
+        with self._lock:
+            opened_at = self.opened_at.get(host)
+            if opened_at is None:
+                return
+            if time.monotonic() - opened_at >= self.cooldown and host not in self.probing:
+                self.probing.add(host)
+                logger.debug(f"Circuit breaker for {host}: sending a probe request.")
+                return
+        stats.count("rejected")
+        raise CircuitOpenError(f"{host} failed {self.threshold} times in a row. Not contacting it for now.")
+
+    def end_probe(self, host):
+        """Let the next request probe host again if the probe ended without an outcome."""
+        with self._lock:
+            self.probing.discard(host)
+
+    def record_success(self, host):
+        with self._lock:
+            if host in self.opened_at:
+                logger.info(f"{host} is reachable again.")
+            self.failures.pop(host, None)
+            self.opened_at.pop(host, None)
+            self.probing.discard(host)
+
+    def record_failure(self, host):
+        if self.threshold <= 0:
+            return
+        with self._lock:
+            self.failures[host] = self.failures.get(host, 0) + 1
+            self.probing.discard(host)
+            if self.failures[host] >= self.threshold:
+                if host not in self.opened_at:
+                    logger.warning(f"{host} failed {self.failures[host]} times in a row. "
+                                   f"Pausing requests to it for {self.cooldown}s.")
+                self.opened_at[host] = time.monotonic()
+
+
+breaker = CircuitBreaker(circuit_breaker_threshold, circuit_breaker_cooldown)
+
+page_policy = RetryPolicy("page", retry_attempts, retry_base_delay, retry_max_delay)
+cache_url_policy = RetryPolicy("cache url", retry_attempts, retry_base_delay, retry_max_delay)
+download_policy = RetryPolicy("download", retry_attempts, retry_base_delay * 5, retry_max_delay)
+
+# ------------------------------------------------------- #
+#                      functions
+# ------------------------------------------------------- #
+
+
+def is_retryable(error):
+    """Transient network errors and retryable HTTP status codes, but not an open circuit."""
+    if isinstance(error, CircuitOpenError):
+        return False
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and error.response.status_code in RETRYABLE_STATUS_CODES
+    return isinstance(error, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError))
+
+
+def format_stats():
+    retries = ", ".join(f"{name} {count}" for name, count in sorted(stats.retries.items())) or "none"
+    return "Retries: {}. Gave up {} times, circuit breakers rejected {} requests.".format(
+        retries, stats.gave_up, stats.rejected)
@@ -1,24 +1,27 @@
 import base64
 import json
 import re
+import time
 import m3u8
 import requests
-import urllib.request
-from urllib.error import URLError
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from urllib.parse import urljoin
 
 from bs4 import BeautifulSoup
 
 from src.custom_logging import setup_logger
-from src.logic.language import ProviderError, get_href_by_language
-from src.constants import (provider_priority)
+from src.logic import extract, parse_pool, transport
+from src.logic.language import LanguageError, ProviderError
+from src.logic.provider_scoreboard import scoreboard
+from src.logic.retry import cache_url_policy
+from src.constants import provider_hedge_delay
 
 logger = setup_logger(__name__)
 
 # ------------------------------------------------------- #
 #                   definitions
 # ------------------------------------------------------- #
-cache_url_attempts = 0
+hedge_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="resolve")
 
 # ------------------------------------------------------- #
 #                   global variables
@@ -27,6 +30,8 @@ VOE_PATTERNS = [re.compile(r"'hls': '(?P<url>.+)'"),
                 re.compile(r'prompt\("Node",\s*"(?P<url>[^"]+)"'),
                 re.compile(r"window\.location\.href = '(?P<url>[^']+)'")]
 STREAMTAPE_PATTERN = re.compile(r'get_video\?id=[^&\'\s]+&expires=[^&\'\s]+&ip=[^&\'\s]+&token=[^&\'\s]+\'')
+# window.location.href redirects of VOE pages followed at most
+MAX_PAGE_REDIRECTS = 3
 
 # ------------------------------------------------------- #
 #                      functions
@@ -37,8 +42,7 @@ STREAMTAPE_PATTERN = re.compile(r'get_video\?id=[^&\'\s]+&expires=[^&\'\s]+&ip=[
 
 
 def get_highest_quality_stream(m3u8_master_url):
-    response = requests.get(m3u8_master_url)
-    response.raise_for_status()
+    response = transport.fetch(m3u8_master_url, rate_limited=False)
 
     base_url = m3u8_master_url.rsplit("/", 1)[0] + "/"
     playlist = m3u8.loads(response.text)
@@ -58,67 +62,85 @@ def get_highest_quality_stream(m3u8_master_url):
 #       NEW VOE DEOBFUSCATION FUNCTION 2025-05-01         #
 # --------------------------------------------------------#
 
-def find_script_element_voenew(raw_html):
-    soup = BeautifulSoup(raw_html, features="html.parser")
-    MKGMa_pattern = r'MKGMa="(.*?)"'
-    match = re.search(MKGMa_pattern, str(soup), re.DOTALL)
-
-    if not match:
-        logger.info("[*] Searching for new MKGMa application/json ...")
-        MKGMa_pattern=r'<script type="application/json">.*\[(.*?)\]</script>'
-        match = re.search(MKGMa_pattern, str(soup), re.DOTALL)
-    if match:
+def decode_voe_payload(raw_html):
+    """
+    Find the obfuscated MKGMa block of a VOE page and decode it. Returns the
+    decoded JSON, {"mp4"/"hls": url} found in a payload that is not JSON, or
+    None. Pure parsing without network access, so it can run in the parse pool.
+    """
+    raw_MKGMa = extract.mkgma_block(raw_html)
+    if raw_MKGMa is None:
+        # the serialized parse tree normalizes markup the raw page may spell differently
+        serialized = str(BeautifulSoup(raw_html, features="html.parser"))
+        MKGMa_pattern = r'MKGMa="(.*?)"'
+        match = re.search(MKGMa_pattern, serialized, re.DOTALL)
+
+        if not match:
+            logger.info("[*] Searching for new MKGMa application/json ...")
+            MKGMa_pattern=r'<script type="application/json">.*\[(.*?)\]</script>'
+            match = re.search(MKGMa_pattern, serialized, re.DOTALL)
+        if not match:
+            return None
         raw_MKGMa = match.group(1)
 
-        def rot13_decode(s: str) -> str:
-            result = []
-            for c in s:
-                if 'A' <= c <= 'Z':
-                    result.append(chr((ord(c) - ord('A') + 13) % 26 + ord('A')))
-                elif 'a' <= c <= 'z':
-                    result.append(chr((ord(c) - ord('a') + 13) % 26 + ord('a')))
-                else:
-                    result.append(c)
-            return ''.join(result)
+    def rot13_decode(s: str) -> str:
+        result = []
+        for c in s:
+            if 'A' <= c <= 'Z':
+                result.append(chr((ord(c) - ord('A') + 13) % 26 + ord('A')))
+            elif 'a' <= c <= 'z':
+                result.append(chr((ord(c) - ord('a') + 13) % 26 + ord('a')))
+            else:
+                result.append(c)
+        return ''.join(result)
+
+    def shift_characters(s: str, offset: int) -> str:
+        return ''.join(chr(ord(c) - offset) for c in s)
 
-        def shift_characters(s: str, offset: int) -> str:
-            return ''.join(chr(ord(c) - offset) for c in s)
+    try:
+        step1 = rot13_decode(raw_MKGMa)
+        step2 = step1.replace('_', '')
+        step3 = base64.b64decode(step2).decode('utf-8')
+        step4 = shift_characters(step3, 3)
+        step5 = step4[::-1]
 
+        decoded = base64.b64decode(step5).decode('utf-8')
         try:
-            step1 = rot13_decode(raw_MKGMa)
-            step2 = step1.replace('_', '')
-            step3 = base64.b64decode(step2).decode('utf-8')
-            step4 = shift_characters(step3, 3)
-            step5 = step4[::-1]
+            return json.loads(decoded)
+        except json.JSONDecodeError:
+            logger.error("[-] Decoded string is not valid JSON. Attempting fallback regex search...")
+
+            mp4_match = re.search(r'(https?://[^\s"]+\.mp4[^\s"]*)', decoded)
+            m3u8_match = re.search(r'(https?://[^\s"]+\.m3u8[^\s"]*)', decoded)
+
+            if mp4_match:
+                logger.info("[+] Found base64 encoded MP4 URL.")
+                return {"mp4": mp4_match.group(1)}
+            elif m3u8_match:
+                logger.info("[+] Found base64 encoded HLS (m3u8) URL.")
+                return {"hls": m3u8_match.group(1)}
+    except Exception as e:
+        logger.error(f"[-] Error while decoding MKGMa string: {e}")
+    return None
+
 
-            decoded = base64.b64decode(step5).decode('utf-8')
+def find_script_element_voenew(raw_html):
+    payload = parse_pool.parse(decode_voe_payload, raw_html)
+    if payload is not None:
+        source_json = {}
+        if 'source' in payload:
             try:
-                parsed_json = json.loads(decoded)
-                if 'source' in parsed_json:
-                    try:
-                        best_quality_url, res_height = get_highest_quality_stream(parsed_json['source'])
-                        source_json = {"hls": best_quality_url}
-                        logger.info(f"[+] Choosed best Quality {res_height}p in .m3u8")
-                    except Exception as e:
-                        logger.error(f"[!] Error while parsing .m3u8-File: {e}")
-                        source_json = {"hls": parsed_json['source']}  # fallback to master.m3u8
-                elif 'direct_access_url' in parsed_json:
-                    source_json = {"mp4": parsed_json['direct_access_url']}
-                    logger.info("[+] Found direct .mp4 URL in JSON (no .m3u8 fallback available).")
-            except json.JSONDecodeError:
-                logger.error("[-] Decoded string is not valid JSON. Attempting fallback regex search...")
-
-                mp4_match = re.search(r'(https?://[^\s"]+\.mp4[^\s"]*)', decoded)
-                m3u8_match = re.search(r'(https?://[^\s"]+\.m3u8[^\s"]*)', decoded)
-
-                if mp4_match:
-                    source_json = {"mp4": mp4_match.group(1)}
-                    logger.info("[+] Found base64 encoded MP4 URL.")
-                elif m3u8_match:
-                    source_json = {"hls": m3u8_match.group(1)}
-                    logger.info("[+] Found base64 encoded HLS (m3u8) URL.")
-        except Exception as e:
-            logger.error(f"[-] Error while decoding MKGMa string: {e}")
+                best_quality_url, res_height = get_highest_quality_stream(payload['source'])
+                source_json = {"hls": best_quality_url}
+                logger.info(f"[+] Choosed best Quality {res_height}p in .m3u8")
+            except Exception as e:
+                logger.error(f"[!] Error while parsing .m3u8-File: {e}")
+                source_json = {"hls": payload['source']}  # fallback to master.m3u8
+        elif 'direct_access_url' in payload:
+            source_json = {"mp4": payload['direct_access_url']}
+            logger.info("[+] Found direct .mp4 URL in JSON (no .m3u8 fallback available).")
+        else:
+            source_json = payload
         try:
             if "mp4" in source_json:
                 link = source_json["mp4"]
@@ -168,209 +190,216 @@ def find_script_element_voenew(raw_html):
 #       NEW VOE DEOBFUSCATION FUNCTION 2025-05-01 END     #
 # --------------------------------------------------------#
 
-def get_year(url):
-    try:
-        html_page = urllib.request.urlopen(url)
-        soup = BeautifulSoup(html_page, features="html.parser")
-        year = None
-        
-        # Version 1: Alte Struktur mit itemprop
-        year_old = soup.find("span", {"itemprop": "startDate"})
-        if year_old:
-            year = year_old.text.strip()
-            print("Alte Struktur gefunden")
-            
-        # Version 2: Neue Struktur
-        if not year:
-            year_element = soup.find("p", class_="small text-muted mb-2")
-            if year_element:
-                year_link = year_element.find("a")
-                if year_link:
-                    year = year_link.text.strip()
-                    print("Neue Struktur gefunden")
-        
-        # Version 3: Alternative Suche in der neuen Struktur
-        if not year:
-            year_element = soup.find("div", class_="col-12 col-md-9 col-lg-10")
-            if year_element:
-                year_link = year_element.find("a", class_="small text-muted")
-                if year_link:
-                    year = year_link.text.strip()
-                    print("Alternative neue Struktur gefunden")
-        
-        if year:
-            print(f"Jahr: {year}")
-            return year
-        else:
-            print("Kein Jahr gefunden")
-            return None
-            
-    except Exception as e:
-        print(f"Fehler: {e}")
-        return None
-    
-
+def get_redirect_link(site_url, offer, provider):
+    href_value, lang_key = offer
+    link_to_redirect = site_url + href_value
+    logger.debug("Link to redirect is: " + link_to_redirect)
+    return link_to_redirect, provider, lang_key
+     
 
-def get_redirect_link_by_provider(site_url, internal_link, language, provider):
+def candidates_from_offers(site_url, offers, language, provider):
     """
-    Sets the priority in which downloads are attempted.
-    First -> VOE download, if not available...
-    Second -> Streamtape download, if not available...
-    Third -> Vidoza download
-    Fourth -> SpeedFiles download
-
-    Parameters:
-        site_url (String): serie or anime site.
-        internal_link (String): link of the html page of the episode.
-        language (String): desired language to download the video file in.
-        provider (String): define the provider to use.
+    Offers of the episode in scoreboard order: [(link_to_redirect, provider, lang_key)].
+    Raises LanguageError when the page has offers, but not in language.
+    """
+    providers = scoreboard.ordered_providers(provider)
+    candidates = []
+    for candidate in providers:
+        # a provider without the language is normal, it is only worth an error when no provider has it
+        offer = offers.find(language, candidate)
+        if offer is not None:
+            candidates.append(get_redirect_link(site_url, offer, candidate))
+    if not candidates:
+        offers.log_missing(language, providers)
+        if offers.lacks_language(language):
+            raise LanguageError(f"The episode is not offered in '{language}'.")
+    return candidates
+
+
+def resolve_candidates(internal_link, candidates):
+    """
+    Resolve the first working stream url from candidates as returned by
+    candidates_from_offers.
+
+    With provider_hedge_delay set, every further provider is started when the ones already
+    running have not delivered within that delay; the first usable cache url
+    wins and the remaining attempts are cancelled (attempts that already run
+    finish in the background and are ignored).
 
     Returns:
-        get_redirect_link(): returns link_to_redirect and provider.
+        cache_url, provider, lang_key and link_to_redirect of the winner.
     """
-    local_provider_priority = provider_priority.copy()
-    local_provider_priority.remove(provider)
+    if provider_hedge_delay <= 0:
+        for redirect_link, candidate, lang_key in candidates:
+            cache_url = timed_find_cache_url(redirect_link, candidate)
+            if cache_url:
+                return cache_url, candidate, lang_key, redirect_link
+            logger.info(f"Provider {candidate} failed. Trying the next provider.")
+        raise ProviderError(f"Could not resolve a stream url for {internal_link}.")
+
+    pending = {}
+    waiting = list(candidates)
+    while waiting or pending:
+        if waiting:
+            redirect_link, candidate, lang_key = waiting.pop(0)
+            logger.debug(f"Hedged resolve: starting {candidate} for {internal_link}")
+            pending[hedge_executor.submit(timed_find_cache_url, redirect_link, candidate)] = (redirect_link, candidate, lang_key)
+        done, _ = wait(pending, timeout=provider_hedge_delay if waiting else None, return_when=FIRST_COMPLETED)
+        for future in done:
+            redirect_link, candidate, lang_key = pending.pop(future)
+            cache_url = None if future.exception() else future.result()
+            if cache_url:
+                for other in pending:
+                    other.cancel()
+                logger.debug(f"Hedged resolve: {candidate} won for {internal_link}")
+                return cache_url, candidate, lang_key, redirect_link
+            logger.info(f"Provider {candidate} failed.")
+    raise ProviderError(f"Could not resolve a stream url for {internal_link}.")
+
+
+def timed_find_cache_url(url, provider):
+    """find_cache_url that reports its outcome and duration to the provider scoreboard."""
+    started = time.monotonic()
+    cache_url = 0
     try:
-        return get_redirect_link(site_url, internal_link, language, provider)
-    except ProviderError:
-        logger.info(f"Provider {provider} failed. Trying {local_provider_priority[0]} next.")
-        try:
-            return get_redirect_link(site_url, internal_link, language, local_provider_priority[0])
-        except ProviderError:
-            logger.info(f"Provider {local_provider_priority[0]} failed. Trying {local_provider_priority[1]} next.")
-            return get_redirect_link(site_url, internal_link, language, local_provider_priority[1])
-
+        cache_url = find_cache_url(url, provider)
+        return cache_url
+    finally:
+        scoreboard.record_resolve(provider, bool(cache_url), time.monotonic() - started)
 
-def get_redirect_link(site_url, html_link, language, provider):
-    html_response = urllib.request.urlopen(html_link)
-    href_value, lang_key = get_href_by_language(html_response, language, provider)
-    link_to_redirect = site_url + href_value
-    logger.debug("Link to redirect is: " + link_to_redirect)
-    return link_to_redirect, provider, lang_key
-     
 
-def find_cache_url(url, provider):
-    global cache_url_attempts
+def find_cache_url(url, provider, redirects=0):
+    """
+    Fetch the provider page behind url and extract the stream url from it.
+    Pages that load but lack the expected element are fetched again under the
+    cache url retry policy. redirects counts the page redirects followed to
+    get to url. Returns 0 when no stream url could be found.
+    """
     logger.debug("Enterd {} to cache for url {}".format(provider,url))
-    try:
-        html_page = urllib.request.urlopen(url)
-    except URLError as e:
-        if "11004" in str(e):
-            logger.error("DNS Error. Please check your DNS settings.")
+    for attempt in range(1, cache_url_policy.attempts + 1):
+        try:
+            html_page = transport.fetch(url)
+        except requests.RequestException as e:
+            if "11004" in str(e) or "NameResolutionError" in str(e):
+                logger.error("DNS Error. Please check your DNS settings.")
+            else:
+                logger.warning(f"{e}")
+                logger.error("Could not find cache url HTML for {}.".format(provider))
             return 0
-        logger.warning(f"{e}")
-        logger.info("Trying again to read HTML Element...")
-        if cache_url_attempts < 5:
-            return find_cache_url(url, provider)
+        try:
+            cache_link = extract_cache_url(url, provider, html_page, redirects)
+        except AttributeError as e:
+            logger.error(f"ERROR: {e}")
+            if attempt == cache_url_policy.attempts:
+                cache_url_policy.give_up()
+                logger.error("Could not find cache url for {}.".format(provider))
+                return 0
+            cache_url_policy.wait(attempt, f"No cache url on the {provider} page.")
+            continue
+        logger.debug("Exiting {} to Cache".format(provider))
+        return cache_link
+
+
+def extract_vidoza_source(raw_html):
+    """src of the video source on a Vidoza page. Raises AttributeError if there is none."""
+    src = extract.video_source(raw_html)
+    if src:
+        return src
+    soup = BeautifulSoup(raw_html, features="html.parser")
+    return soup.find("source").get("src")
+
+
+def extract_cache_url(url, provider, html_page, redirects=0):
+    """Stream url from a fetched provider page. Raises AttributeError when the page lacks it."""
+    if provider == "Vidoza":
+        cache_link = parse_pool.parse(extract_vidoza_source, html_page.content)
+    elif provider == "SpeedFiles":
+        cache_link = re.search(r'src="([^"]+)"', html_page.text).group(1)
+        logger.debug(f"Link: {cache_link}")
+        if "store_access" in cache_link:
+            logger.info("Found SpeedFiles mp4 Link!")
+            return cache_link
+    elif provider == "VOE":
+        html_page = html_page.text
+        ## New Version of VOE 2025-05-01
+        cache_url = find_script_element_voenew(html_page)
+        if cache_url:
+            return cache_url
         else:
-            logger.error("Could not find cache url HTML for {}.".format(provider))
-            return 0
-    try:
-        if provider == "Vidoza":
-            soup = BeautifulSoup(html_page, features="html.parser")
-            cache_link = soup.find("source").get("src")
-        elif provider == "SpeedFiles":
-            cache_link = re.search(r'src="([^"]+)"', html_page.read().decode('utf-8')).group(1)
-            logger.debug(f"Link: {cache_link}")
-            if "store_access" in cache_link:
-                logger.info("Found SpeedFiles mp4 Link!")
-                return cache_link
-        elif provider == "VOE":
-            html_page = html_page.read().decode('utf-8')
-            ## New Version of VOE 2025-05-01
-            cache_url = find_script_element_voenew(html_page)
-            if cache_url:
-                return cache_url
-            else:
-                logger.info(f"Older VOE page. Trying a different methode...")
-            ##
-            # new Version of VOE uses a b64 encoded block which is also backwards.
-            try:
-                b64_match = re.search(r"var a168c='([^']+)'", html_page)
-                if b64_match:
-                    logger.debug("Found b64 encoded block. Decoding...")
-                    html_page = base64.b64decode(b64_match.group(1)).decode('utf-8')[::-1]
-                    html_page = json.loads(html_page)
-                    html_page = html_page["source"]
-                    return html_page
-            except AttributeError:
-                logger.info("Could not find b64 encoded block. Older VOE Version")
-
-            for VOE_PATTERN in VOE_PATTERNS:
-                match = VOE_PATTERN.search(html_page)
-                if match:
-                    if match.group(0).startswith("window.location.href"):
-                        logger.info("Found window.location.href. Redirecting...")
-                        logger.debug(f"Redirecting to {match.group(1)}")
-                        return find_cache_url(match.group(1), provider)
-                    cache_link = match.group(1)
-                    cache_link = base64.b64decode(cache_link).decode('utf-8')
-                    if cache_link and cache_link.startswith("https://"):
-                        return cache_link
-            try:
-                    headers = {
-                        "User-Agent": "Mozilla/5.0"
-                    }
-
-                    req = urllib.request.Request(url, headers=headers)
-                    response = urllib.request.urlopen(req)
-                    html = response.read().decode("utf-8")
-
-                    soup = BeautifulSoup(html, "html.parser")
-
-                    # 1. iframe holen (BESTER WEG)
-                    iframe = soup.find("iframe", {"id": "player-iframe"})
-                    if not iframe:
-                        logger.info("Kein iframe gefunden")
-                        return None
-
-                    src = iframe.get("src")
-                    full_url = urllib.parse.urljoin(url, src)
-
-                    logger.info(f"[DEBUG] iframe URL: {full_url}")
-
-                    # 2. iframe Seite laden
-                    req2 = urllib.request.Request(full_url, headers=headers)
-                    response2 = urllib.request.urlopen(req2)
-                    html2 = response2.read().decode("utf-8")
-
-                    # 3. Suche nach echten Video URLs
-                    # typische Patterns
-                    patterns = [
-                        r'https://[^"]+\.m3u8',
-                        r'https://[^"]+\.mp4'
-                    ]
-
-                    for pattern in patterns:
-                        match = re.search(pattern, html2)
-                        if match:
-                            logger.info(f"[DEBUG] Found video: {match.group(0)}")
-                            return match.group(0)
-
-                    logger.info("Kein Video-Link gefunden")
+            logger.info(f"Older VOE page. Trying a different methode...")
+        ##
+        # new Version of VOE uses a b64 encoded block which is also backwards.
+        try:
+            b64_match = re.search(r"var a168c='([^']+)'", html_page)
+            if b64_match:
+                logger.debug("Found b64 encoded block. Decoding...")
+                html_page = base64.b64decode(b64_match.group(1)).decode('utf-8')[::-1]
+                html_page = json.loads(html_page)
+                html_page = html_page["source"]
+                return html_page
+        except AttributeError:
+            logger.info("Could not find b64 encoded block. Older VOE Version")
+
+        for VOE_PATTERN in VOE_PATTERNS:
+            match = VOE_PATTERN.search(html_page)
+            if match:
+                if match.group(0).startswith("window.location.href"):
+                    if redirects >= MAX_PAGE_REDIRECTS:
+                        logger.error(f"{provider} redirected {redirects} times. Giving up at {url}.")
+                        return 0
+                    logger.info("Found window.location.href. Redirecting...")
+                    logger.debug(f"Redirecting to {match.group(1)}")
+                    return find_cache_url(match.group(1), provider, redirects + 1)
+                cache_link = match.group(1)
+                cache_link = base64.b64decode(cache_link).decode('utf-8')
+                if cache_link and cache_link.startswith("https://"):
+                    return cache_link
+        try:
+                # the provider page was fetched already
+                soup = BeautifulSoup(html_page, "html.parser")
+
+                # 1. iframe holen (BESTER WEG)
+                iframe = soup.find("iframe", {"id": "player-iframe"})
+                if not iframe:
+                    logger.info("Kein iframe gefunden")
                     return None
-            except AttributeError:
-                logger.info("Could not find cache url voe")
 
-            logger.error("Could not find cache url for {}.".format(provider))
-            return 0
-        elif provider == "Streamtape":
-            cache_link = STREAMTAPE_PATTERN.search(html_page.read().decode('utf-8'))
-            if cache_link is None:
-                return find_cache_url(url, provider)
-            cache_link = "https://" + provider + ".com/" + cache_link.group()[:-1]
-            logger.debug(f"This is the found video link of {provider}: {cache_link}")
-    except AttributeError as e:
-        logger.error(f"ERROR: {e}")
-        logger.info("Trying again...")
-        if cache_url_attempts < 5:
-            cache_url_attempts += 1
-            return find_cache_url(url, provider)
-        else:
-            logger.error("Could not find cache url for {}.".format(provider))
-            return 0
-        
-    logger.debug("Exiting {} to Cache".format(provider))
+                src = iframe.get("src")
+                full_url = urljoin(url, src)
+
+                logger.info(f"[DEBUG] iframe URL: {full_url}")
+
+                # 2. iframe Seite laden
+                html2 = transport.fetch(full_url).text
+
+                # 3. Suche nach echten Video URLs
+                # typische Patterns
+                patterns = [
+                    r'https://[^"]+\.m3u8',
+                    r'https://[^"]+\.mp4'
+                ]
+
+                for pattern in patterns:
+                    match = re.search(pattern, html2)
+                    if match:
+                        logger.info(f"[DEBUG] Found video: {match.group(0)}")
+                        return match.group(0)
+
+                logger.info("Kein Video-Link gefunden")
+                return None
+        except AttributeError:
+            logger.info("Could not find cache url voe")
+        except requests.RequestException as e:
+            logger.warning(f"Could not load the VOE player page: {e}")
+
+        logger.error("Could not find cache url for {}.".format(provider))
+        return 0
+    elif provider == "Streamtape":
+        cache_link = STREAMTAPE_PATTERN.search(html_page.text)
+        if cache_link is None:
+            raise AttributeError("Streamtape page contains no video link")
+        cache_link = "https://" + provider + ".com/" + cache_link.group()[:-1]
+        logger.debug(f"This is the found video link of {provider}: {cache_link}")
     return cache_link
 
 # ------------------------------------------------------- #
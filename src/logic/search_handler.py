@@ -1,7 +1,8 @@
-import requests
 from thefuzz import process
 from bs4 import BeautifulSoup
 
+from src.logic import transport
+
 class Search_Handler:
     def __init__(self):
         self.base_url = f"https://aniworld.to/animes"
@@ -17,7 +18,7 @@ class Search_Handler:
             url = self.base_url_sto
         else:
             return None
-        response = requests.get(url)
+        response = transport.get(url)
         soup = BeautifulSoup(response.text, 'html.parser')
         name_list = []
         for name in soup.find_all('div', class_='genre'):
@@ -0,0 +1,148 @@
+from threading import Lock
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util import make_headers
+
+from src.constants import http_connect_timeout, http_pool_size, http_read_timeout
+from src.custom_logging import setup_logger
+from src.logic.rate_limiter import limiter
+from src.logic.retry import RETRYABLE_STATUS_CODES, breaker, page_policy
+
+logger = setup_logger(__name__)
+
+# ------------------------------------------------------- #
+#                   definitions
+# ------------------------------------------------------- #
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) " \
+             "Chrome/124.0 Safari/537.36"
+# gzip/deflate, plus br when a brotli decoder is installed
+ACCEPT_ENCODING = make_headers(accept_encoding=True)["accept-encoding"]
+DEFAULT_TIMEOUT = (http_connect_timeout, http_read_timeout)
+# media must arrive byte for byte, otherwise Range offsets don't line up
+MEDIA_HEADERS = {"Accept-Encoding": "identity"}
+
+# ------------------------------------------------------- #
+#                      classes
+# ------------------------------------------------------- #
+
+
+class TransportStats:
+    def __init__(self):
+        self._lock = Lock()
+        self.connections_opened = 0
+        self.requests = 0
+
+    def connection_opened(self):
+        with self._lock:
+            self.connections_opened += 1
+
+    def request_sent(self):
+        with self._lock:
+            self.requests += 1
+
+    @property
+    def connections_reused(self):
+        return max(self.requests - self.connections_opened, 0)
+
+
+stats = TransportStats()
+
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        stats.connection_opened()
+        return super()._new_conn()
+
+    def urlopen(self, *args, **kwargs):
+        stats.request_sent()
+        return super().urlopen(*args, **kwargs)
+
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        stats.connection_opened()
+        return super()._new_conn()
+
+    def urlopen(self, *args, **kwargs):
+        stats.request_sent()
+        return super().urlopen(*args, **kwargs)
+
+
+class CountingHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose keep-alive pools report opened connections and sent requests."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": CountingHTTPConnectionPool,
+            "https": CountingHTTPSConnectionPool,
+        }
+
+
+# ------------------------------------------------------- #
+#                      functions
+# ------------------------------------------------------- #
+
+
+def create_session():
+    new_session = requests.Session()
+    # one keep-alive pool per host, each holding up to http_pool_size connections
+    adapter = CountingHTTPAdapter(pool_connections=32, pool_maxsize=http_pool_size)
+    new_session.mount("https://", adapter)
+    new_session.mount("http://", adapter)
+    new_session.headers.update({"User-Agent": USER_AGENT, "Accept-Encoding": ACCEPT_ENCODING})
+    return new_session
+
+
+session = create_session()
+
+
+def get(url, rate_limited=True, **kwargs) -> requests.Response:
+    """
+    Single GET through the shared session. Fails fast with CircuitOpenError
+    while the host's circuit breaker is open, otherwise waits for the host's
+    rate limiter, and reports the outcome to both. Media requests to CDNs
+    (segments, ranges, playlists) pass rate_limited=False: they only go
+    through the breaker, the limiter's rates are meant for site and
+    provider pages.
+    """
+    kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+    host = urlparse(url).hostname
+    breaker.before_request(host)
+    try:
+        if rate_limited:
+            limiter.acquire(host)
+        try:
+            response = session.get(url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            breaker.record_failure(host)
+            raise
+        if response.status_code >= 500 and response.status_code in RETRYABLE_STATUS_CODES:
+            breaker.record_failure(host)
+        else:
+            breaker.record_success(host)
+    finally:
+        # a probe that failed with any other error (bad url, too many redirects, ...) must not keep the host half-open
+        breaker.end_probe(host)
+    if rate_limited:
+        limiter.feedback(host, response, body_loaded=not kwargs.get("stream"))
+    return response
+
+
+def fetch_once(url, **kwargs) -> requests.Response:
+    response = get(url, **kwargs)
+    response.raise_for_status()
+    return response
+
+
+def fetch(url, **kwargs) -> requests.Response:
+    """GET url, retrying transient failures, and raise requests.HTTPError for 4xx/5xx answers."""
+    return page_policy.call(fetch_once, url, **kwargs)
+
+
+def format_stats():
+    return "HTTP: {} requests, {} connections opened, {} reused.".format(
+        stats.requests, stats.connections_opened, stats.connections_reused)
@@ -48,8 +48,10 @@ def read_config_variable(variable_name, default=None):
                         return str(line.split('=', 1)[1].strip())
                     else:
                         return int(line.split('=', 1)[1].strip())
-        return logger.info("variable not found")
+        logger.info(f"variable {variable_name} not found")
+        return default
     except:
-        return logger.info(f"variable not found")
+        logger.info(f"variable {variable_name} not found")
+        return default
 
 
@@ -1,23 +1,19 @@
 import os
-import time
 import subprocess
-from threading import active_count
 from time import sleep
 
-from src.constants import (APP_VERSION, ddos_protection_calc, ddos_wait_timer,
-                           language, name, output_path, season_override,
-                           site_url, type_of_media, url, dlMode, cliProvider, output_root, output_name,
-                           thread_download_wait_timer, max_download_threads, disable_thread_timer)
+from src.constants import APP_VERSION, output_root, output_name, resolve_queue_size, resolve_workers
 from src.custom_logging import setup_logger
-from src.logic.collect_all_seasons_and_episodes import get_episodes, get_season, get_movies
-from src.logic.downloader import already_downloaded, create_new_download_thread, normalize_filename
+from src.logic.collect_all_seasons_and_episodes import SeriesIndex
+from src.logic.directory_index import directory_index, normalize_filename
+from src.logic.downloader import already_downloaded, get_download_pool, queue_episode
+from src.logic import page_cache, rate_limiter, retry, transport
 from src.logic.language import LanguageError
-from src.logic.search_for_links import (find_cache_url, get_redirect_link_by_provider, get_year)
+from src.logic.library import get_manifest
+from src.logic.pipeline import EpisodeJob, Progress, ResolveStage, RunSettings, SeriesSpec
 from src.failures import write_fails
 from src.successes import write_success
 
-already_downloaded_speicher = False
-
 logger = setup_logger(__name__)
 
 def find_existing_folder_by_normalized_name(parent_path, target_name, year):
@@ -51,6 +47,131 @@ def find_existing_folder_by_normalized_name(parent_path, target_name, year):
     # If no existing folder found, return the new path
     return f"{parent_path}/{target_name} ({year})"
 
+def is_missing(job):
+    """True unless job is on disk already, as mp4 or mkv."""
+    if already_downloaded(job.file_name(job.series.language)) or \
+            already_downloaded(job.file_name(job.series.language, "mkv")):
+        job.emit("skipped")
+        return False
+    return True
+
+
+def episode_jobs(series, series_index, output_path, seasons, starting_season, progress=None):
+    """
+    Yield an EpisodeJob for every episode/movie of the requested seasons that
+    is not downloaded yet. Season pages are only fetched when the generator
+    gets to them. Stops at the next episode once progress is cancelled.
+    """
+    movies_listed = False
+    for season in range(int(seasons)):
+        if progress and progress.cancelled:
+            return
+        if season < starting_season:
+            continue
+        if not starting_season:
+            season = season + 1 if series.season_override == 0 else series.season_override
+        else:
+            season = season + 1
+        season = int(season)
+
+        if series.dl_mode.lower() != 'series' and not movies_listed:
+            movies_listed = True
+            season_path_movies = f"{output_path}/Movies"
+            os.makedirs(season_path_movies, exist_ok=True)
+            episode_count_movies = series_index.movie_count()
+            logger.info("Show has {} Movie(s)/Special(s).".format(episode_count_movies))
+            for episode in range(1, episode_count_movies + 1):
+                if progress and progress.cancelled:
+                    return
+                job = EpisodeJob(series, season, episode, series.url + "filme/film-{}".format(episode),
+                                 season_path_movies, is_movie=True, progress=progress)
+                if is_missing(job):
+                    yield job
+
+        if series.dl_mode.lower() != 'movies':
+            season_path_series = f"{output_path}/Season {season:02}"
+            os.makedirs(season_path_series, exist_ok=True)
+            episode_count_series = series_index.episode_count(season)
+            logger.info("Season {} has {} Episodes.".format(season, episode_count_series))
+            for episode in range(1, episode_count_series + 1):
+                if progress and progress.cancelled:
+                    return
+                job = EpisodeJob(series, season, episode, series.url + "staffel-{}/episode-{}".format(season, episode),
+                                 season_path_series, progress=progress)
+                if is_missing(job):
+                    yield job
+
+
+def series_jobs(series, progress=None):
+    """
+    Look up series on the site, pick its output folder and return a generator
+    of the EpisodeJobs of the requested seasons that are not downloaded yet.
+    The lookup happens right away, so its errors are raised here and not
+    from inside a running pipeline.
+    """
+    # one fetch of the series page for seasons, year and title; season pages are fetched on demand
+    series_index = SeriesIndex(series.url)
+
+    # if user wants to download all seasons starting from X it would be X+ so 2+ would be 2,3,4...
+    str_season_override = str(series.season_override)
+    if "+" in str_season_override:
+        starting_season = int(str_season_override.replace("+", "")) - 1
+        logger.info(f"Starting Season is: {starting_season + 1}")
+        seasons = series_index.season_count
+    else:
+        starting_season = 0
+        if series.season_override == 0:
+            logger.info("No Season override detected.")
+            if series.dl_mode.lower() == 'movies':
+                seasons = 1
+            else:
+                seasons = series_index.season_count
+            logger.info("We have this many seasons: {}".format(seasons))
+        else:
+            logger.info("Season Override detected. Override set to: {}".format(series.season_override))
+            seasons = 1
+
+    year = series_index.year
+    # opened before the first already-downloaded check, so it also answers for a changed output_root
+    get_manifest(series.settings.output_root)
+    media_path = f"{series.settings.output_root}/{series.type_of_media}"
+    os.makedirs(media_path, exist_ok=True)
+    output_path = find_existing_folder_by_normalized_name(media_path, series.output_name, year)
+    os.makedirs(output_path, exist_ok=True)
+    if progress:
+        progress.emit("series", title=series_index.title, year=year, seasons=seasons, output_path=output_path)
+
+    return episode_jobs(series, series_index, output_path, seasons, starting_season, progress)
+
+
+async def resolve_offers(resolver, job):
+    """
+    Provider offers of job, or None to skip it. The short-lived stream url is
+    resolved by the download worker right before the download starts.
+    """
+    if job.cancelled:
+        return None
+    try:
+        candidates = await resolver.candidates(job.series.site_url, job.link, job.series.language,
+                                               job.series.provider)
+    except LanguageError:
+        job.emit("unavailable")
+        return None
+    if not candidates:
+        logger.error(f"Could not find cache url on {job}.")
+        job.emit("unavailable")
+        return None
+    return candidates
+
+
+def log_run_summary():
+    logger.info("------------- Run summary ------------")
+    logger.info(transport.format_stats())
+    logger.info(page_cache.format_stats())
+    logger.info(rate_limiter.format_stats())
+    logger.info(retry.format_stats())
+
+
 def is_ffmpeg_installed():
     # Attempt to execute ffmpeg
     try:
@@ -60,247 +181,80 @@ def is_ffmpeg_installed():
     except FileNotFoundError:
         return False
 
-# ------------------------------------------------------- #
-#                       main
-# ------------------------------------------------------- #
-
-def main():
-    ddos_start_value = 0
-
-    logger.info("------------- AnimeSerienScraper {} started ------------".format(APP_VERSION))
 
+def check_environment(root=None):
+    """True if the working directory is usable and ffmpeg can be run. Creates root (default: output_root) if needed."""
+    root = root or output_root
     read_check = os.access('DO_NOT_DELETE.txt', os.R_OK)
     if read_check:
         logger.debug("We have Read Permission")
     else:
         logger.error("No Read Permission. Please check if you own the Folder and/or have "
                      "permissions to read.")
-        exit()
+        return False
     write_check = os.access('DO_NOT_DELETE.txt', os.W_OK)
     if write_check:
         logger.debug("We have Write Permission")
     else:
         logger.error("No Write Permission. Please check if you own the Folder and/or have "
                      "permissions to write.")
-        exit()
+        return False
 
-    if not os.path.exists(output_root):
+    if not os.path.exists(root):
         logger.info("Output folder does not exist. Creating it now.")
-        os.makedirs(output_root, exist_ok=True)
-
-    if output_name == "Name-Goes-Here":
-        logger.error("Name is Default. Please reade readme before starting.")
-        exit()
+        os.makedirs(root, exist_ok=True)
 
     # Check if FFMPEG is installed before even trying to download episodes
     if not is_ffmpeg_installed():
         logger.error("FFMPEG is not installed or could not be run. You can download it at https://ffmpeg.org/")
-        exit()
-
-    # if user wants to download all seasons starting from X it would be X+ so 2+ would be 2,3,4...
-    str_season_override = str(season_override)
-    if "+" in str_season_override:
-        starting_season = int(season_override.replace("+", "")) - 1
-        logger.info(f"Starting Season is: {starting_season + 1}")
-        seasons = get_season(url)
-    else:
-        starting_season = 0
-        if season_override == 0:
-            logger.info("No Season override detected.")
-            if dlMode.lower() == 'movies':
-                seasons = 1
-            else:
-                seasons = get_season(url)
-            logger.info("We have this many seasons: {}".format(seasons))
-        else:
-            logger.info("Season Override detected. Override set to: {}".format(season_override))
-            seasons = 1
+        return False
+    return True
 
 
-    year = get_year(url)
-    media_path = f"{output_root}/{type_of_media}"
-    os.makedirs(media_path, exist_ok=True)
-    output_path = find_existing_folder_by_normalized_name(media_path, output_name, year)
-    os.makedirs(output_path, exist_ok=True)
+def run_jobs(jobs, progress=None, settings=None):
+    """
+    Resolve and download every EpisodeJob of jobs with the RunSettings settings
+    (default: the ones read at import). Returns once the downloads reported
+    to progress finished, without progress once the pool is idle.
+    """
+    settings = settings or RunSettings.from_constants()
+    # the pool and the limiter are shared by every run of the process and follow the latest settings
+    download_pool = get_download_pool(settings)
+    rate_limiter.limiter.configure(settings.rate_limit_initial, settings.rate_limit_max)
+    # generator -> resolve stage -> download pool, each handing over through a bounded queue,
+    # so downloads of one season run while the next one is enumerated and resolved
+    resolve_stage = ResolveStage(resolve_offers, queue_episode, resolve_workers, resolve_queue_size)
+    try:
+        for job in jobs:
+            resolve_stage.put(job)
+    finally:
+        # also when the generator raises, the jobs queued so far are still resolved and downloaded
+        resolve_stage.close()
+    if progress:
+        progress.wait()
+    else:
+        download_pool.wait()
 
-    threadpool = []
 
-    for season in range(int(seasons)):
-        if season < starting_season:
-            continue
-        if not starting_season:
-            season = season + 1 if season_override == 0 else season_override
-        else:
-            season = season + 1
-        season = int(season)
-        if dlMode.lower() == 'movies':
-            season_path_movies = f"{output_path}/Movies"
-            os.makedirs(season_path_movies, exist_ok=True)
-        elif dlMode.lower() == 'series':
-            season_path_series = f"{output_path}/Season {season:02}"
-            os.makedirs(season_path_series, exist_ok=True)
-        else:
-            season_path_movies = f"{output_path}/Movies"
-            season_path_series = f"{output_path}/Season {season:02}"
-            os.makedirs(season_path_movies, exist_ok=True)
-            os.makedirs(season_path_series, exist_ok=True)
-
-        if dlMode.lower() == 'movies':
-            episode_count_movies = get_movies(url)
-            logger.info("Show has {} Movie(s)/Special(s).".format(episode_count_movies))
-        elif dlMode.lower() == 'series':
-            episode_count_series = get_episodes(url, season)
-            logger.info("Season {} has {} Episodes.".format(season, episode_count_series))
-        else:
-            episode_count_movies = get_movies(url)
-            episode_count_series = get_episodes(url, season)
-            logger.info("Show has {} Movies/Specials.".format(episode_count_movies))
-            logger.info("Season {} has {} Episodes.".format(season, episode_count_series))
+def download_series(series, progress=None):
+    """
+    Download the missing episodes of series in the calling thread and return
+    the Progress of the run once they are finished. Unlike main() it takes
+    everything from series instead of the command line and neither exits
+    nor writes the run logs, so a server can run several shows at once from
+    its own threads; they share the download pool, connections and caches.
+    Errors looking up the show are raised.
+    """
+    progress = progress or Progress()
+    # files may have been added or removed since the last run of this process
+    directory_index.clear()
+    run_jobs(series_jobs(series, progress), progress, series.settings)
+    return progress
 
-        if dlMode.lower() == 'movies':
-            for episode in range(int(episode_count_movies)):
-                episode = episode + 1
-                file_name_mkv = "{}/{}-{}.mkv".format(season_path_movies, name, episode)
-                file_name = "{}/{}-{}.mp4".format(season_path_movies, name, episode)
-                logger.info("File name will be: " + file_name)
-                already_downloaded_speicher = already_downloaded(file_name) or already_downloaded(file_name_mkv)
-                if not already_downloaded_speicher:
-                    link = url + "filme/film-{}".format(episode)
-                    try:
-                        redirect_link, provider, lang_key = get_redirect_link_by_provider(site_url[type_of_media], link, language, cliProvider)
-                    except LanguageError:
-                        continue
-                    if ddos_start_value < ddos_protection_calc:
-                        logger.debug("Entered DDOS var check and starting new downloader.")
-                        ddos_start_value += 1
-                    else:
-                        logger.info("Started {} Downloads. Waiting for {} Seconds to not trigger DDOS"
-                                    "Protection.".format(ddos_protection_calc, ddos_wait_timer))
-                        time.sleep(ddos_wait_timer)
-                        ddos_start_value = 1
-                    cache_url = find_cache_url(redirect_link, provider)
-                    if cache_url == 0:
-                        logger.error(f"Could not find cache url for {provider} on {season}, {episode}.")
-                        continue
-                    logger.debug("{} Cache URL is: ".format(provider) + cache_url)
-                    threadpool.append(create_new_download_thread(cache_url, file_name, provider))
-
-            already_downloaded_speicher = False
-
-        elif dlMode.lower() == 'series':
-            for episode in range(int(episode_count_series)):
-                episode = episode + 1
-                file_name_mkv = "{}/{} - s{:02}e{:02} - {}.mkv".format(season_path_series, name, season, episode, language)
-                file_name = "{}/{} - s{:02}e{:02} - {}.mp4".format(season_path_series, name, season, episode, language)
-                already_downloaded_speicher = already_downloaded(file_name) or already_downloaded(file_name_mkv)
-                if not already_downloaded_speicher:
-                    link = url + "staffel-{}/episode-{}".format(season, episode)
-                    try:
-                        redirect_link, provider, lang_key = get_redirect_link_by_provider(site_url[type_of_media], link, language, cliProvider)
-                        if lang_key != language:
-                            logger.debug(f"Language key {lang_key} does not match requested language {language}. "
-                                           f"Using {lang_key} instead in file name.")
-                            file_name = file_name.replace(language, lang_key)
-                    except LanguageError:
-                        continue
-                    if ddos_start_value < ddos_protection_calc:
-                        logger.debug("Entered DDOS var check and starting new downloader.")
-                        ddos_start_value += 1
-                    else:
-                        logger.info("Started {} Downloads. Waiting for {} Seconds to not trigger DDOS"
-                                    "Protection.".format(ddos_protection_calc, ddos_wait_timer))
-                        time.sleep(ddos_wait_timer)
-                        ddos_start_value = 1
-                    cache_url = find_cache_url(redirect_link, provider)
-                    if cache_url == 0:
-                        logger.error(f"Could not find cache url for {provider} on {season}, {episode}.")
-                        continue
-                    logger.debug("{} Cache URL is: ".format(provider) + cache_url)
-                    logger.info("File name will be: " + file_name)
-                    threadpool.append(create_new_download_thread(cache_url, file_name, provider))
-            already_downloaded_speicher = False
-            
-        else:
-            for episode in range(int(episode_count_movies)):
-                episode = episode + 1
-                file_name = "{}/{}-{}.mp4".format(season_path_movies, name, episode)
-                file_name_mkv = "{}/{}-{}.mkv".format(season_path_movies, name, episode)
-                already_downloaded_speicher = already_downloaded(file_name) or already_downloaded(file_name_mkv)
-                if not already_downloaded_speicher:
-                    link = url + "filme/film-{}".format(episode)
-                    try:
-                        redirect_link, provider, lang_key = get_redirect_link_by_provider(site_url[type_of_media], link, language, cliProvider)
-                    except LanguageError:
-                        continue
-                    if ddos_start_value < ddos_protection_calc:
-                        logger.debug("Entered DDOS var check and starting new downloader.")
-                        ddos_start_value += 1
-                    else:
-                        logger.info("Started {} Downloads. Waiting for {} Seconds to not trigger DDOS"
-                                    "Protection.".format(ddos_protection_calc, ddos_wait_timer))
-                        time.sleep(ddos_wait_timer)
-                        ddos_start_value = 1
-                    cache_url = find_cache_url(redirect_link, provider)
-                    if cache_url == 0:
-                        logger.error(f"Could not find cache url for {provider} on {season}, {episode}.")
-                        continue
-                    logger.debug("{} Cache URL is: ".format(provider) + cache_url)
-                    if lang_key != language:
-                        logger.warning(f"Language key {lang_key} does not match requested language {language}. "
-                                       f"Using {lang_key} instead in file name.")
-                        file_name = file_name.replace(language, lang_key)
-                    logger.info("File name will be: " + file_name)
-                    threadpool.append(create_new_download_thread(cache_url, file_name, provider))
-            already_downloaded_speicher = False
-
-            for episode in range(int(episode_count_series)):
-                episode = episode + 1
-                file_name_mkv = "{}/{} - s{:02}e{:02} - {}.mkv".format(season_path_series, name, season, episode, language)
-                file_name = "{}/{} - s{:02}e{:02} - {}.mp4".format(season_path_series, name, season, episode, language)
-                already_downloaded_speicher = already_downloaded(file_name) or already_downloaded(file_name_mkv)
-                if not already_downloaded_speicher:
-                    link = url + "staffel-{}/episode-{}".format(season, episode)
-                    try:
-                        redirect_link, provider, lang_key = get_redirect_link_by_provider(site_url[type_of_media], link, language, cliProvider)
-                    except LanguageError:
-                        continue
-                    active_threads = active_count()
-                    logger.debug(f"Active Threads START: {active_threads}")
-                    if ddos_start_value < ddos_protection_calc:
-                        logger.debug("Entered DDOS var check and starting new downloader.")
-                        ddos_start_value += 1
-                    else:
-                        logger.info("Started {} Downloads. Waiting for {} Seconds to not trigger DDOS"
-                                    "Protection.".format(ddos_protection_calc, ddos_wait_timer))
-                        time.sleep(ddos_wait_timer)
-                        active_threads = active_count()
-                        if not disable_thread_timer:
-                            while active_threads > max_download_threads:
-                                logger.info(f"Active Threads: {active_threads}. Waiting {thread_download_wait_timer}s "
-                                            f"before checking again if we are under {max_download_threads} threads.")
-                                time.sleep(thread_download_wait_timer)
-                                active_threads = active_count()
-                        logger.debug(f"Resetting DDOS Counter to 1.")
-                        ddos_start_value = 1
-                    cache_url = find_cache_url(redirect_link, provider)
-                    if cache_url == 0:
-                        logger.error(f"Could not find cache url for {provider} on {season}, {episode}.")
-                        continue
-                    logger.debug("{} Cache URL is: ".format(provider) + cache_url)
-                    if lang_key != language:
-                        logger.warning(f"Language key {lang_key} does not match requested language {language}. "
-                                       f"Using {lang_key} instead in file name.")
-                        file_name = file_name.replace(language, lang_key)
-                    logger.info("File name will be: " + file_name)
-                    threadpool.append(create_new_download_thread(cache_url, file_name, provider))
-                    active_threads = active_count()
-                    logger.debug(f"Active Threads STARTED: {active_threads}")
-
-            already_downloaded_speicher = False
-
-        for thread in threadpool:
-            thread.join()
 
+def finish_run():
+    """Write the run summary, successes and failures and exit with 2 if anything failed."""
+    log_run_summary()
     write_success()
     failed = write_fails()
     if failed:
@@ -309,3 +263,19 @@ def main():
     else:
         logger.info("All Episodes downloaded successfully.")
         exit(0)
+
+# ------------------------------------------------------- #
+#                       main
+# ------------------------------------------------------- #
+
+def main():
+    logger.info("------------- AnimeSerienScraper {} started ------------".format(APP_VERSION))
+
+    if output_name == "Name-Goes-Here":
+        logger.error("Name is Default. Please reade readme before starting.")
+        exit()
+
+    if not check_environment():
+        exit()
+    run_jobs(series_jobs(SeriesSpec.from_constants()))
+    finish_run()
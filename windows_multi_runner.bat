@@ -5,7 +5,7 @@ rem last change: 2024.08.21_6:15
 rem change list:
 rem 0.0.1 INITIAL COMMIT
 
-set SCRIPT_PATH=main.py
+set SCRIPT_PATH=py_batch.py
 
 echo.
 echo Choose a type:
@@ -45,9 +45,7 @@ cls
 echo.
 echo Enter a list of names separated by spaces. Example: "name1 name2 name3"
 set /p NAMES=Names:
-for %%N in (%NAMES%) do (
-    rem run the script with the current name
-    python %SCRIPT_PATH% --type %TYPE% --name %%N --lang %LANGUAGE% --dl-mode %DLMODE% --provider %PROVIDER%
-)
+rem run all names in one process
+python %SCRIPT_PATH% --type %TYPE% --lang %LANGUAGE% --dl-mode %DLMODE% --provider %PROVIDER% %NAMES%
 echo Done!
 pause
\ No newline at end of file